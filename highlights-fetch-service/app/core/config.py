@@ -41,6 +41,7 @@ class Settings(BaseSettings):
     GEMINI_API_KEY: Optional[SecretStr] = None  # Google AI Studio API key
     GEMINI_MODEL: str = "gemini-3-flash-preview"  # Model for text analysis (fast, powerful)
     GEMINI_IMAGE_MODEL: Optional[str] = "gemini-2.5-flash-image"  # Model for image generation (set to empty string or None to disable)
+    MERMAID_LOCAL_RENDER: bool = False  # Render Mermaid diagrams with a local `mmdc` (mermaid-cli) before falling back to mermaid.ink
     
     @field_validator('JWT_SECRET_KEY')
     @classmethod
@@ -0,0 +1,12 @@
+"""
+CORS configuration, parsed once at import from the FRONTEND_URL environment variable.
+"""
+import os
+
+# FRONTEND_URL is "*" (any origin), a single origin, or a comma-separated list of origins
+_frontend_url = os.getenv("FRONTEND_URL", "*")
+
+if _frontend_url == "*":
+    ALLOWED_ORIGINS = ["*"]
+else:
+    ALLOWED_ORIGINS = [origin.strip() for origin in _frontend_url.split(",") if origin.strip()]
@@ -133,13 +133,11 @@ class DatabaseSyncService:
         """
         temp_file = None
         try:
-            # Check if already syncing
-            if sync_state.is_busy():
+            # Claim the sync; rejected if one is already running
+            if not sync_state.set_checking():
                 logger.warning("Sync already in progress, skipping")
                 return False
             
-            sync_state.set_checking()
-            
             if self.is_local_cache_stale():
                 logger.info("Database needs sync, starting download...")
                 
@@ -7,21 +7,319 @@ Supports automatic diagram generation using gemini-2.5-flash-image.
 """
 
 import asyncio
+import base64
+import hashlib
 import html
-import io
 import logging
 import re
-from typing import Optional, Union, List
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, Optional, Union, List, Set, Tuple
+import aiohttp
+import orjson
 from telegram import Update, Bot, Message, PhotoSize
 from telegram.ext import Application, ContextTypes, MessageHandler, filters
 from telegram.error import BadRequest
 from google import genai
 from google.genai import types
 from app.core.config import settings
-import base64
+from app.services.markdown_html import markdown_to_html
 
 logger = logging.getLogger(__name__)
 
+# Markdown code fences around JSON returned by Gemini (```json ... ```)
+_JSON_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
+# Outermost JSON object in a response that has stray text around it
+_JSON_OBJECT_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+# Maximum number of Gemini requests in flight at once
+_GEMINI_MAX_CONCURRENCY = 8
+
+# Per-request timeout for Gemini HTTP calls, in milliseconds
+_GEMINI_TIMEOUT_MS = 60_000
+
+# Heuristic gate for highlights that might benefit from a diagram
+# (whole words, plurals included)
+_DIAGRAM_HINT_RE = re.compile(
+    r"\b(?:(?:algorithm|system|architecture|protocol|flow|pipeline|graph|tree|queue|stack|layer|network|state"
+    r"|buffer|throughput|latency|kernel|thread|lock|cache|distributed|consensus)s?"
+    r"|schema(?:s|ta)?|process(?:es)?|hash(?:es)?|ind(?:ex(?:es)?|ices)|topolog(?:y|ies))\b",
+    re.IGNORECASE
+)
+_MIN_DIAGRAM_TEXT_LEN = 80
+_MAX_NON_ALNUM_RATIO = 0.3
+
+# Keywords that mean the user is asking for a visual/diagram explanation
+# (plural and derived forms included, but not words that merely contain one, e.g. "paragraph")
+_VISUAL_RE = re.compile(
+    r"\b(diagram(?:s|med|m?atic(?:ally)?)?|visuali[sz](?:e[sd]?|ing|ations?)|visual(?:s|ly)?|"
+    r"draw(?:s|n|ings?)?|sketch(?:es)?|show(?:s)?|illustrat(?:e[sd]?|ing|ions?)|"
+    r"(?:flow)?charts?|graphs?|pictures?|images?|explain with)\b",
+    re.IGNORECASE
+)
+
+# Diagram types that mark text as Mermaid code
+_MERMAID_KEYWORDS = ("graph", "flowchart", "sequenceDiagram", "classDiagram", "stateDiagram", "erDiagram")
+_MERMAID_KEYWORD_RE = re.compile("|".join(_MERMAID_KEYWORDS))
+# First fenced code block: group 1 is set for ```mermaid blocks, group 2 is the body
+# (for other blocks the rest of the opening line, e.g. a language tag, is skipped)
+_MERMAID_BLOCK_RE = re.compile(r"```(?:(mermaid)|[^\n]*\n)(.*?)```", re.DOTALL)
+
+# mermaid.ink circuit breaker: pause rendering after this many consecutive failures
+_MERMAID_MAX_FAILURES = 5
+_MERMAID_COOLDOWN_SECONDS = 60
+# Largest rendered diagram accepted from mermaid.ink, and the chunk size it's read in
+_MERMAID_MAX_IMAGE_BYTES = 2_000_000
+_MERMAID_READ_CHUNK_BYTES = 16384
+# Local mermaid-cli rendering (see _render_mermaid_locally): concurrent mmdc processes and per-render timeout
+_MMDC_MAX_CONCURRENCY = 2
+_MMDC_TIMEOUT_SECONDS = 20
+
+
+@lru_cache(maxsize=1024)
+def _wants_visual_explanation(text: str) -> bool:
+    """
+    Check if the user is asking for a visual/diagram explanation.
+    
+    Cached because the same message is checked by several handlers/prompts,
+    and short requests ("show me", retries) repeat often.
+    
+    Args:
+        text: The user's message text
+        
+    Returns:
+        True if user wants a visual explanation
+    """
+    return _VISUAL_RE.search(text) is not None
+
+
+# Telegram BadRequest messages that mean the formatting (not the request) was invalid
+_PARSE_ERR_RE = re.compile(r"can't (parse entities|find end)", re.IGNORECASE)
+
+
+# Magic-byte prefixes for image formats Gemini accepts (JPEG is the fallback)
+_MIME_SIGNATURES = (
+    (b'\x89PNG', "image/png"),
+    (b'GIF', "image/gif"),
+)
+
+# Number of Gemini text responses kept for repeated prompts (see _generate_text)
+_RESPONSE_CACHE_MAX_ENTRIES = 512
+
+# Streamed replies: placeholder shown before the first chunk, and the minimum gap
+# between edits (Telegram allows roughly one edit per second per chat)
+_STREAM_PLACEHOLDER = "🤖 …"
+_STREAM_EDIT_INTERVAL_SECONDS = 0.8
+# Appended to the partial text when a stream fails midway
+_STREAM_INTERRUPTED_NOTICE = "\n\n_(response interrupted, please ask again)_"
+
+# Byte budget for downloaded Telegram photos kept for follow-up questions
+_PHOTO_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+def _sniff_image_mime_type(image_bytes: bytes) -> str:
+    """Detect an image's MIME type from its first 12 bytes, defaulting to JPEG."""
+    header = memoryview(image_bytes)[:12]
+    for signature, mime_type in _MIME_SIGNATURES:
+        if header[:len(signature)] == signature:
+            return mime_type
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return "image/webp"
+    return "image/jpeg"
+
+
+@lru_cache(maxsize=128)
+def _escape_html_cached(text: str) -> str:
+    """Escape &, < and > for Telegram HTML mode, reusing results for repeated texts."""
+    return html.escape(text, quote=False)
+
+
+def _head(text: str, max_chars: int = 300) -> str:
+    """
+    Take the start of a text for a prompt, preferring to end on a sentence boundary.
+    
+    Args:
+        text: Text to truncate
+        max_chars: Maximum length of the result
+        
+    Returns:
+        The text itself if short enough, otherwise its first max_chars characters,
+        cut back to the last full sentence when that keeps most of them
+    """
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    dot = cut.rfind(". ")
+    return cut[:dot + 1] if dot > max_chars * 0.6 else cut
+
+
+# Prompt templates - static scaffolding built once, only the slots are filled per call
+
+_SHORT_SUMMARY_PROMPT = """You are a concise reading companion. 
+
+Book: "{book}" by {author}{chapter_context}
+
+Highlighted Text:
+"{text}"
+
+Provide a ONE SENTENCE summary (max 150 characters) explaining the KEY concept or main idea. Be concise and clear."""
+
+# Static part of the highlight analysis prompt. Kept separate from the per-highlight
+# details so the prompt shared by every highlight is sent as the system instruction.
+_ANALYSIS_SYSTEM_INSTRUCTION = """You are an expert reading companion specializing in technical, engineering, and scientific literature (but also knowledgeable about general topics).
+
+The user will tell you which book they are reading and the passage they've highlighted.
+
+Provide insightful analysis that:
+1. **Explains key concepts clearly** - Break down technical terms, principles, or ideas
+2. **Provides practical context** - How does this apply in real-world scenarios?
+3. **Connects to broader themes** - How does this relate to the book's main topics or the field in general?
+4. **Offers actionable insights** - What should the reader take away or explore further?
+
+Keep your response:
+- Concise (2-3 paragraphs max)
+- Technically accurate when dealing with engineering/scientific content
+- Conversational and genuinely helpful
+- Focused on practical understanding
+
+If this is a technical/engineering book, focus on concepts, applications, and principles.
+If it's fiction or non-technical, provide literary or thematic analysis instead."""
+
+_ANALYSIS_HIGHLIGHT_PROMPT = 'Book: "{book}" by {author}{chapter_context}\n\nHighlighted passage:\n"{text}"'
+
+# Per-call turn for the Mermaid path: the highlight plus the diagram decision, sent
+# with _ANALYSIS_SYSTEM_INSTRUCTION so analysis and diagram come from one Gemini call
+_ANALYSIS_AND_DIAGRAM_PROMPT = _ANALYSIS_HIGHLIGHT_PROMPT + """
+
+Besides the analysis, decide if this concept would genuinely benefit from a visual diagram:
+- System architectures
+- Data structures
+- Algorithms / Flowcharts
+- Workflows / Processes
+- Comparisons / Relationships
+- Database schemas
+
+If YES, write valid Mermaid code (starting with the diagram type like "flowchart TD" or "graph LR") that is simple, clear, and focused on the core concept.
+
+Respond with ONLY a JSON object in this exact format:
+{{"analysis": "<your analysis, Markdown allowed>", "needs_diagram": true or false, "mermaid_code": "<Mermaid code, or null if no diagram is needed>"}}"""
+
+_DIRECT_IMAGE_PROMPT = """Based on this highlighted text from "{book}" by {author}:
+
+"{text}"
+
+Create a clean, professional technical diagram that illustrates this concept. The diagram should:
+- Be simple and clear
+- Use a whiteboard or technical drawing style
+- Include labeled components
+- Be easy to understand at a glance
+- Focus on the core concept
+
+Only generate an image if this concept would genuinely benefit from visualization (system architectures, data flows, algorithms, etc.).
+
+If a diagram wouldn't add value, respond with text "SKIP" instead."""
+
+_IMAGE_ANALYSIS_PROMPT = """You are an expert assistant with vision capabilities, specializing in technical, engineering, and scientific content analysis.
+
+A user has shared an image and asked:
+"{question}"
+
+Analyze the image carefully and provide a thoughtful, detailed response that:
+1. **Describes what you see** - Key elements, structure, content
+2. **Answers their specific question** - Address exactly what they asked
+3. **Provides context and insights** - Explain technical concepts, patterns, or relationships you observe
+4. **Offers additional observations** - Share relevant details they might find interesting
+
+If the image contains:
+- Technical diagrams: Explain the architecture, flow, or components
+- Code/text: Analyze and explain the content
+- Charts/graphs: Interpret the data and trends
+- Documents: Summarize and explain key points
+- General photos: Describe and contextualize what's shown
+
+Be detailed, accurate, and genuinely helpful."""
+
+_DIRECT_IMAGE_FROM_TEXT_PROMPT = """User's question: "{question}"
+
+Text explanation provided:
+{answer}...{context_text}
+
+Create a clean, professional technical diagram or visual that illustrates this concept. The diagram should:
+- Be simple, clear, and easy to understand
+- Use a whiteboard or technical drawing style
+- Include labeled components and relationships
+- Focus on the core concept being explained
+- Use appropriate diagram type (flowchart, architecture, comparison, etc.)
+
+Make it visually informative and complement the text explanation."""
+
+_MERMAID_FROM_TEXT_PROMPT = """User's question: "{question}"
+
+Text explanation:
+{answer}...{context_text}
+
+**Task**: Generate a Mermaid diagram that visually explains this concept.
+
+Create valid Mermaid code that:
+- Uses the appropriate diagram type (flowchart, sequenceDiagram, classDiagram, graph, etc.)
+- Is simple and focused on the core concept
+- Includes clear labels and relationships
+- Is technically accurate
+
+Respond with ONLY the Mermaid code (starting with the diagram type like "flowchart TD" or "graph LR").
+Do NOT include markdown code fences or explanations."""
+
+_GENERAL_ANSWER_PROMPT = """You are an expert assistant specializing in technical, engineering, and scientific topics, but also knowledgeable about general subjects.
+
+A user has asked you a question:
+{question}
+
+Provide a thoughtful, accurate response that:
+1. **Directly answers their question** with precision and clarity
+2. **Explains complex concepts simply** - Break down technical terms when needed
+3. **Provides practical context** - Include real-world examples or applications
+4. **Offers additional insights** - Share related information that might be helpful
+5. Is concise (2-3 paragraphs) but comprehensive
+
+If the question is about technical/engineering topics:
+- Use precise terminology but explain it clearly
+- Provide concrete examples or use cases
+- Suggest related concepts to explore
+
+If the question is about general topics:
+- Be informative and engaging
+- Provide relevant context and background
+- Share interesting connections or perspectives
+
+Be warm, knowledgeable, and genuinely helpful.{visual_instruction}"""
+
+_FOLLOW_UP_SYSTEM_INSTRUCTION = """You are an expert reading companion specializing in technical, engineering, and scientific literature (but also knowledgeable about general topics).
+
+You're in a conversation with a reader about their book. Each message gives you the previous context and the reader's follow-up question.
+
+Provide a thoughtful response that:
+1. **Directly answers their question** with technical accuracy
+2. **Builds on the previous context** - Reference what was already discussed
+3. **Offers deeper insights** - Go beyond the surface when appropriate
+4. **Suggests connections** - Link to related concepts, chapters, or real-world applications
+5. Is concise (2-3 paragraphs) but comprehensive
+
+If discussing technical/engineering topics:
+- Use precise terminology but explain it clearly
+- Provide practical examples or applications
+- Suggest related concepts to explore
+
+Be warm, knowledgeable, and genuinely helpful."""
+
+_FOLLOW_UP_PROMPT = """Previous context:
+{previous_context}
+
+The reader's follow-up question:
+{question}{visual_instruction}"""
+
+_VISUAL_INSTRUCTION = "\n\n**IMPORTANT**: The user has requested a visual/diagram explanation. DO NOT create ASCII art or text-based diagrams in your response. Instead, describe the concept clearly in text - a proper visual diagram will be generated separately and sent after this message."
+
 
 class KoboAICompanion:
     """
@@ -40,32 +338,82 @@ class KoboAICompanion:
     
     def __init__(
         self,
-        telegram_token: str,
+        bot: Bot,
         gemini_api_key: str,
         chat_id: str,
         text_model: str = "gemini-3-flash-preview",
-        image_model: Optional[str] = None
+        image_model: Optional[str] = None,
+        mermaid_local_render: bool = False
     ):
         """
         Initialize the Kobo AI Companion service.
         
         Args:
-            telegram_token: Telegram bot API token from @BotFather
+            bot: Telegram Bot used for every send (shared with the webhook Application)
             gemini_api_key: Google AI Studio API key
             chat_id: Telegram chat/group ID where highlights are sent
             text_model: Gemini model for text analysis (default: gemini-3-flash-preview)
             image_model: Gemini model for image generation (default: None/disabled)
+            mermaid_local_render: Render Mermaid with a local mmdc before mermaid.ink (default: False)
         """
-        self.telegram_token = telegram_token
         self.chat_id = chat_id
+        # Incoming updates carry integer chat IDs; compare against an int instead of
+        # formatting every update's ID as a string. A non-numeric ID (e.g. @channel)
+        # can't match any update, same as the string comparison before.
+        try:
+            self._chat_id_int: Optional[int] = int(chat_id)
+        except (TypeError, ValueError):
+            self._chat_id_int = None
         self.text_model = text_model
         self.image_model = image_model if image_model else None
         
-        # Configure Gemini with Cloud SDK
-        self.client = genai.Client(api_key=gemini_api_key)
+        # Image generation approach, decided once from the model name:
+        # "direct" (Gemini image/Imagen models), "mermaid" (text model → mermaid.ink) or None
+        image_model_lower = (image_model or "").lower()
+        if "2.5-flash-image" in image_model_lower or "imagen" in image_model_lower:
+            self._image_mode: Optional[str] = "direct"
+        else:
+            self._image_mode = "mermaid" if self.image_model else None
+        
+        # Configure Gemini with Cloud SDK. One client per companion, so its HTTP
+        # connection pool (and keep-alive connections) is shared by every call
+        self.client = genai.Client(
+            api_key=gemini_api_key,
+            http_options=types.HttpOptions(timeout=_GEMINI_TIMEOUT_MS)
+        )
+        
+        # Telegram bot, shared with the webhook Application so both use one HTTP pool
+        self.bot = bot
+        
+        # Bound concurrent Gemini calls (see _generate_content)
+        self._gemini_sem = asyncio.Semaphore(_GEMINI_MAX_CONCURRENCY)
+        
+        # Strong references to fire-and-forget tasks (see _fire_and_forget)
+        self._background_tasks: Set[asyncio.Task] = set()
+        
+        # Per-chat update queues so one slow chat doesn't block others (see _enqueue)
+        self._chat_queues: Dict[int, asyncio.Queue] = {}
+        self._chat_workers: Dict[int, asyncio.Task] = {}
+        
+        # Gemini text responses by prompt digest, LRU-evicted (see _generate_text)
+        self._resp_cache: "OrderedDict[bytes, str]" = OrderedDict()
+        # In-flight Gemini requests by the same key, shared by concurrent callers (see _singleflight)
+        self._inflight: Dict[bytes, asyncio.Task] = {}
+        
+        # Downloaded photo bytes by file_id, LRU-evicted (see _download_photo)
+        self._photo_cache: "OrderedDict[str, bytes]" = OrderedDict()
+        self._photo_cache_bytes = 0
         
-        # Create bot instance
-        self.bot = Bot(token=telegram_token)
+        # Shared HTTP session for mermaid.ink, created lazily (see _get_session)
+        self._http_session: Optional[aiohttp.ClientSession] = None
+        
+        # Local mermaid-cli rendering, bounded so headless Chromium instances don't pile up
+        self._mermaid_local_render = mermaid_local_render
+        self._mmdc_sem = asyncio.Semaphore(_MMDC_MAX_CONCURRENCY)
+        
+        # Circuit breaker state for mermaid.ink rendering
+        self._mermaid_failures = 0
+        self._mermaid_cooldown_until = 0.0
         
         logger.info(f"KoboAICompanion initialized:")
         logger.info(f"  - Text model: {text_model}")
@@ -96,47 +444,91 @@ class KoboAICompanion:
             Message ID of the AI analysis message (for threading), or None if failed
         """
         try:
-            # Format the highlight message
-            chapter_text = f" ({chapter})" if chapter else ""
+            # Format the highlight message as HTML, escaping the user-supplied fields
+            chapter_text = f" ({html.escape(chapter, quote=False)})" if chapter else ""
             highlight_message = (
-                f"📖 *{book}*{chapter_text}\n"
-                f"✍️ _by {author}_\n\n"
+                f"📖 <b>{html.escape(book, quote=False)}</b>{chapter_text}\n"
+                f"✍️ <i>by {html.escape(author, quote=False)}</i>\n\n"
                 f"💡 Highlighted:\n"
-                f"> {text}"
-            )
-            
-            # Send highlight to Telegram
-            logger.info(f"Sending highlight from '{book}' to Telegram")
-            highlight_msg = await self.bot.send_message(
-                chat_id=self.chat_id,
-                text=highlight_message,
-                parse_mode="Markdown"
+                f"<blockquote>{html.escape(text, quote=False)}</blockquote>"
             )
             
-            # Generate AI text analysis
+            # Start the Gemini work first so it overlaps with sending the highlight.
+            # Direct image models can't return JSON analysis, so only the Mermaid
+            # path can fuse the analysis and the diagram decision into one call,
+            # and only for passages that could plausibly use a diagram; the direct
+            # image prompt only needs the passage, so it runs alongside.
             logger.info(f"Generating text analysis for '{book}'")
-            ai_response = await self._generate_analysis(text, book, author, chapter)
+            combined = self._image_mode == "mermaid" and self._likely_needs_diagram(text, book)
+            if combined:
+                analysis_task = asyncio.create_task(self._generate_analysis_and_diagram(text, book, author, chapter))
+            else:
+                if self._image_mode == "mermaid":
+                    logger.info("Skipping diagram - passage doesn't look diagrammable")
+                analysis_task = asyncio.create_task(self._generate_analysis(text, book, author, chapter))
+            
+            image_task = None
+            if self._image_mode == "direct":
+                logger.info(f"Attempting to generate diagram for '{book}'")
+                image_task = asyncio.create_task(self._try_generate_image(text, book, author))
             
-            # Send AI analysis as a reply (creates thread)
+            # Send highlight to Telegram
+            logger.info(f"Sending highlight from '{book}' to Telegram")
+            try:
+                highlight_msg = await self.bot.send_message(
+                    chat_id=self.chat_id,
+                    text=highlight_message,
+                    parse_mode="HTML"
+                )
+            except Exception:
+                analysis_task.cancel()
+                if image_task:
+                    image_task.cancel()
+                raise
+            
+            mermaid_code = None
+            image_bytes = None
+            if image_task:
+                ai_response, image_bytes = await asyncio.gather(analysis_task, image_task, return_exceptions=True)
+                if isinstance(ai_response, BaseException):
+                    raise ai_response
+                if isinstance(image_bytes, BaseException):
+                    logger.error(f"Image generation failed: {image_bytes}")
+                    image_bytes = None
+            else:
+                ai_response = await analysis_task
+            render_task = None
+            if combined:
+                ai_response, mermaid_code = ai_response
+                # Render the diagram Gemini decided on while the analysis is sent
+                if mermaid_code:
+                    logger.info(f"Rendering diagram for '{book}'")
+                    render_task = asyncio.create_task(self._render_mermaid_to_png(mermaid_code))
+                else:
+                    logger.info("Gemini decided this concept doesn't need a diagram")
+
+            # Send AI analysis as a reply (creates thread), converted to HTML
             logger.info(f"Sending AI analysis as reply")
-            analysis_msg = await self.bot.send_message(
+            analysis_msg = await self._safe_send_message(
                 chat_id=self.chat_id,
-                text=f"🤖 *AI Analysis:*\n\n{ai_response}",
-                parse_mode="Markdown",
+                text=f"🤖 **AI Analysis:**\n\n{ai_response}",
                 reply_to_message_id=highlight_msg.message_id
             )
+            if analysis_msg is None:
+                if render_task:
+                    render_task.cancel()
+                return None
             
-            # Try to generate and send a diagram (if image generation is enabled)
-            if self.image_model:
-                logger.info(f"Attempting to generate diagram for '{book}'")
-                image_bytes = await self._try_generate_image(text, book, author, ai_response)
-                
+            if self._image_mode:
+                if render_task:
+                    image_bytes = await render_task
+
                 if image_bytes:
                     try:
                         # Send image as a reply to the analysis (in the same thread)
                         await self.bot.send_photo(
                             chat_id=self.chat_id,
-                            photo=io.BytesIO(image_bytes),
+                            photo=image_bytes,
                             caption="🎨 Visual explanation",
                             reply_to_message_id=analysis_msg.message_id
                         )
@@ -151,63 +543,6 @@ class KoboAICompanion:
             logger.error(f"Error sending highlight with analysis: {e}", exc_info=True)
             return None
     
-    def _markdown_to_html(self, text: str) -> str:
-        """
-        Convert common Markdown syntax to HTML tags for Telegram HTML parse mode.
-        
-        This is used as a fallback when Markdown parsing fails. It converts:
-        - **bold** → <b>bold</b>
-        - *italic* → <i>italic</i>
-        - __underline__ → <u>underline</u>
-        - ### Heading → <b>Heading</b>
-        - `code` → <code>code</code>
-        - [link](url) → <a href="url">link</a>
-        
-        Args:
-            text: Text with Markdown syntax
-            
-        Returns:
-            Text with HTML tags
-        """
-        # First, escape HTML special characters to avoid conflicts
-        text = html.escape(text, quote=False)
-        
-        # Convert headings (###, ##, #) to bold
-        text = re.sub(r'^#{1,6}\s+(.+)$', r'<b>\1</b>', text, flags=re.MULTILINE)
-        
-        # Convert **bold** (must be before * for italic)
-        text = re.sub(r'\*\*(.+?)\*\*', r'<b>\1</b>', text)
-        
-        # Convert __underline__
-        text = re.sub(r'__(.+?)__', r'<u>\1</u>', text)
-        
-        # Convert *italic* (single asterisk)
-        text = re.sub(r'\*(.+?)\*', r'<i>\1</i>', text)
-        
-        # Convert _italic_ (single underscore) 
-        text = re.sub(r'(?<!\w)_(.+?)_(?!\w)', r'<i>\1</i>', text)
-        
-        # Convert `code`
-        text = re.sub(r'`(.+?)`', r'<code>\1</code>', text)
-        
-        # Convert [link](url) - extract URL first since it's already escaped
-        def replace_link(match):
-            link_text = match.group(1)
-            url = match.group(2)
-            # Unescape the URL since we escaped it earlier
-            url = url.replace('&amp;', '&').replace('&lt;', '<').replace('&gt;', '>')
-            return f'<a href="{url}">{link_text}</a>'
-        
-        text = re.sub(r'\[(.+?)\]\((.+?)\)', replace_link, text)
-        
-        # Convert bullet points (-, *, +) to • 
-        text = re.sub(r'^[\-\*\+]\s+', '• ', text, flags=re.MULTILINE)
-        
-        # Convert numbered lists (1., 2., etc.)
-        text = re.sub(r'^\d+\.\s+', lambda m: f'{m.group(0)} ', text, flags=re.MULTILINE)
-        
-        return text
-    
     def _escape_html(self, text: str) -> str:
         """
         Escape HTML special characters for Telegram HTML parse mode.
@@ -225,7 +560,7 @@ class KoboAICompanion:
         Returns:
             HTML-escaped text
         """
-        return html.escape(text, quote=False)
+        return _escape_html_cached(text)
     
     async def _safe_send_message(
         self,
@@ -239,42 +574,24 @@ class KoboAICompanion:
         Safely send a message with formatting, falling back gracefully on errors.
         
         Strategy:
-        1. Try Markdown mode first (AI generates Markdown syntax like **bold**)
-        2. Fall back to HTML if Markdown parsing fails
-        3. Fall back to plain text if both fail
+        1. Convert the AI's Markdown (**bold**, *italic*, etc.) to HTML up front and
+           send in HTML mode - no round-trip wasted on Telegram's strict Markdown parser
+        2. Fall back to plain text only if Telegram still rejects the HTML
         
         Args:
             chat_id: Chat ID to send to (int or str)
             text: Message text
             reply_to_message_id: Optional message ID to reply to
-            use_markdown: Whether to prefer Markdown mode (default: True)
+            use_markdown: Whether to convert Markdown syntax to HTML tags (default: True).
+                If False, the text is only HTML-escaped.
             **kwargs: Additional arguments for send_message
             
         Returns:
             Sent message object or None if failed
         """
-        # Try Markdown first (AI generates Markdown syntax like **bold**, *italic*, etc.)
-        if use_markdown:
-            try:
-                return await self.bot.send_message(
-                    chat_id=chat_id,
-                    text=text,
-                    parse_mode="Markdown",
-                    reply_to_message_id=reply_to_message_id,
-                    **kwargs
-                )
-            except BadRequest as e:
-                if "can't parse entities" in str(e).lower() or "can't find end" in str(e).lower():
-                    logger.warning(f"Markdown parsing failed: {e}. Trying HTML.")
-                else:
-                    logger.error(f"Markdown BadRequest error: {e}", exc_info=True)
-            except Exception as e:
-                logger.warning(f"Markdown mode failed: {e}. Trying HTML.")
+        html_text = markdown_to_html(text) if use_markdown else self._escape_html(text)
         
-        # Fall back to HTML (convert Markdown to HTML tags)
         try:
-            # Convert Markdown syntax to HTML tags
-            html_text = self._markdown_to_html(text)
             return await self.bot.send_message(
                 chat_id=chat_id,
                 text=html_text,
@@ -283,7 +600,7 @@ class KoboAICompanion:
                 **kwargs
             )
         except BadRequest as e:
-            if "can't parse entities" in str(e).lower() or "can't find end" in str(e).lower():
+            if _PARSE_ERR_RE.search(str(e)):
                 logger.warning(f"HTML parsing failed: {e}. Falling back to plain text.")
             else:
                 logger.error(f"HTML BadRequest error: {e}", exc_info=True)
@@ -328,28 +645,15 @@ class KoboAICompanion:
             chapter_context = f" (from {chapter})" if chapter else ""
             
             # Prompt for very short summary
-            prompt = f"""You are a concise reading companion. 
-
-Book: "{book}" by {author}{chapter_context}
-
-Highlighted Text:
-"{text}"
+            prompt = _SHORT_SUMMARY_PROMPT.format(book=book, author=author, chapter_context=chapter_context, text=text)
 
-Provide a ONE SENTENCE summary (max 150 characters) explaining the KEY concept or main idea. Be concise and clear."""
-
-            # Generate response
-            response = await asyncio.to_thread(
-                self.client.models.generate_content,
-                model=self.text_model,
-                contents=prompt
-            )
+            # Generate response (repeated highlights are served from cache)
+            summary = await self._generate_text(self.text_model, prompt)
             
-            if not response or not response.text:
+            if not summary:
                 logger.warning("Empty response from Gemini for short summary")
                 return "Sent detailed analysis to Telegram!"
             
-            summary = response.text.strip()
-            
             # Ensure it's actually short (qndb limit)
             if len(summary) > 200:
                 summary = summary[:197] + "..."
@@ -360,6 +664,241 @@ Provide a ONE SENTENCE summary (max 150 characters) explaining the KEY concept o
             logger.error(f"Error generating short summary: {e}", exc_info=True)
             return "Sent analysis to Telegram!"
     
+    async def _generate_content(self, **kwargs):
+        """
+        Call Gemini's generate_content through the SDK's native async client.
+        
+        No thread pool hop is involved. A semaphore still bounds how many requests
+        are in flight so a burst of Telegram updates can't flood the Gemini API.
+        
+        Args:
+            **kwargs: Arguments for client.aio.models.generate_content (model, contents, config)
+            
+        Returns:
+            Gemini GenerateContentResponse
+        """
+        async with self._gemini_sem:
+            return await self.client.aio.models.generate_content(**kwargs)
+    
+    async def _generate_text(
+        self,
+        model: str,
+        prompt: str,
+        config: Optional[types.GenerateContentConfig] = None,
+        system_instruction: Optional[str] = None
+    ) -> Optional[str]:
+        """
+        Generate a text response for a prompt, reusing the answer for repeated prompts.
+        
+        Identical prompts (a repeated question or highlight, "show me" again on the
+        same answer) are answered from an in-process LRU keyed by a BLAKE2 digest of
+        model and prompt.
+        
+        Args:
+            model: Gemini model name
+            prompt: Complete prompt text
+            config: Optional generation config (must be the same for a given prompt)
+            system_instruction: Optional static instructions, sent as the system
+                instruction on top of `config`
+            
+        Returns:
+            Stripped response text, or None if Gemini returned nothing
+        """
+        key = self._response_cache_key(model, prompt, system_instruction)
+        cached = self._get_cached_response(key)
+        if cached is not None:
+            return cached
+        
+        call_config = config
+        if system_instruction:
+            call_config = (config or types.GenerateContentConfig()).model_copy(
+                update={"system_instruction": system_instruction}
+            )
+        
+        async def generate() -> Optional[str]:
+            response = await self._generate_content(model=model, contents=prompt, config=call_config)
+            if not response or not response.text:
+                return None
+            
+            text = response.text.strip()
+            self._cache_response(key, text)
+            return text
+        
+        return await self._singleflight(key, generate)
+    
+    async def _singleflight(self, key: bytes, generate: Callable[[], Awaitable]):
+        """
+        Run a Gemini request once for all concurrent callers with the same key.
+        
+        The first caller starts the request as a task; callers arriving while it's
+        in flight await the same task instead of sending a duplicate request. The
+        task is shielded so one caller being cancelled doesn't cancel it for others.
+        No lock is needed - nothing is awaited between the lookup and the insert.
+        
+        Args:
+            key: Response cache key identifying the request
+            generate: Zero-argument coroutine function performing the request
+            
+        Returns:
+            The request's result (exceptions propagate to every caller)
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(generate())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._inflight.pop(key, None) if self._inflight.get(key) is done else None)
+        else:
+            logger.info("Joining in-flight Gemini request")
+        return await asyncio.shield(task)
+    
+    @staticmethod
+    def _response_cache_key(model: str, prompt: str, system_instruction: Optional[str] = None) -> bytes:
+        """Digest identifying a (model, system instruction, prompt) triple in the response cache."""
+        return hashlib.blake2b(f"{model}\0{system_instruction or ''}\0{prompt}".encode(), digest_size=16).digest()
+    
+    def _get_cached_response(self, key: bytes) -> Optional[str]:
+        """Look up a cached response, marking it as recently used."""
+        cached = self._resp_cache.get(key)
+        if cached is not None:
+            self._resp_cache.move_to_end(key)
+            logger.info("Using cached Gemini response")
+        return cached
+    
+    def _cache_response(self, key: bytes, text: str) -> None:
+        """Store a response, evicting the least recently used one over capacity."""
+        self._resp_cache[key] = text
+        if len(self._resp_cache) > _RESPONSE_CACHE_MAX_ENTRIES:
+            self._resp_cache.popitem(last=False)
+    
+    async def _stream_reply(
+        self,
+        chat_id: Union[int, str],
+        model: str,
+        prompt: str,
+        reply_to_message_id: Optional[int] = None,
+        fallback_text: str = "I encountered an error. Please try asking again.",
+        system_instruction: Optional[str] = None,
+        after_stream: Optional[Callable[[str], Awaitable]] = None
+    ) -> Tuple[Optional[Message], str, Optional[asyncio.Task]]:
+        """
+        Stream a Gemini response into a Telegram reply, editing it as text arrives.
+        
+        Sends a placeholder right away, then edits it with the accumulated plain
+        text at most every _STREAM_EDIT_INTERVAL_SECONDS. The final edit converts
+        the complete Markdown to HTML like _safe_send_message. Repeated prompts are
+        answered from the response cache in a single message.
+        
+        Args:
+            chat_id: Chat ID to reply in
+            model: Gemini model name
+            prompt: Prompt text (the per-call user turn)
+            reply_to_message_id: Optional message ID to reply to
+            fallback_text: Text shown if Gemini returns nothing
+            system_instruction: Optional static instructions sent as the system instruction
+            after_stream: Optional coroutine function started with the final text as
+                soon as the stream ends, so it runs alongside the final edit
+            
+        Returns:
+            Tuple of (reply message or None if sending failed, final response text,
+            after_stream task or None)
+        """
+        key = self._response_cache_key(model, prompt, system_instruction)
+        cached = self._get_cached_response(key)
+        if cached is not None:
+            after_task = asyncio.create_task(after_stream(cached)) if after_stream else None
+            reply_msg = await self._safe_send_message(
+                chat_id=chat_id,
+                text=cached,
+                reply_to_message_id=reply_to_message_id
+            )
+            return reply_msg, cached, after_task
+        
+        reply_msg = await self._safe_send_message(
+            chat_id=chat_id,
+            text=_STREAM_PLACEHOLDER,
+            reply_to_message_id=reply_to_message_id,
+            use_markdown=False
+        )
+        if not reply_msg:
+            return None, fallback_text, None
+        
+        chunks: List[str] = []
+        completed = False
+        last_edit = time.monotonic()
+        config = types.GenerateContentConfig(system_instruction=system_instruction) if system_instruction else None
+        try:
+            async with self._gemini_sem:
+                stream = await self.client.aio.models.generate_content_stream(
+                    model=model,
+                    contents=prompt,
+                    config=config
+                )
+                async for chunk in stream:
+                    if not chunk.text:
+                        continue
+                    chunks.append(chunk.text)
+                    
+                    now = time.monotonic()
+                    if now - last_edit >= _STREAM_EDIT_INTERVAL_SECONDS:
+                        # Partial Markdown may not convert cleanly, so show plain text until the end
+                        await self._safe_edit_message(reply_msg, "".join(chunks), use_markdown=False)
+                        last_edit = now
+            completed = True
+        except Exception as e:
+            logger.error(f"Error streaming Gemini response: {e}", exc_info=True)
+        
+        text = "".join(chunks).strip()
+        if not text:
+            logger.warning("Empty streamed response from Gemini")
+            text = fallback_text
+        elif completed:
+            self._cache_response(key, text)
+        else:
+            # Don't let a truncated answer pass for a complete one
+            text += _STREAM_INTERRUPTED_NOTICE
+        
+        after_task = asyncio.create_task(after_stream(text)) if after_stream else None
+        await self._safe_edit_message(reply_msg, text)
+        return reply_msg, text, after_task
+    
+    async def _safe_edit_message(self, message: Message, text: str, use_markdown: bool = True) -> None:
+        """
+        Edit a sent message, falling back to plain text if the formatting is rejected.
+        
+        Args:
+            message: Message to edit
+            text: New message text
+            use_markdown: Whether to convert Markdown syntax to HTML tags (default: True)
+        """
+        html_text = markdown_to_html(text) if use_markdown else self._escape_html(text)
+        
+        try:
+            await self.bot.edit_message_text(
+                chat_id=message.chat_id,
+                message_id=message.message_id,
+                text=html_text,
+                parse_mode="HTML"
+            )
+            return
+        except BadRequest as e:
+            if "not modified" in str(e):
+                return
+            if _PARSE_ERR_RE.search(str(e)):
+                logger.warning(f"HTML parsing failed while editing: {e}. Falling back to plain text.")
+            else:
+                logger.error(f"HTML BadRequest error while editing: {e}", exc_info=True)
+        except Exception as e:
+            logger.warning(f"HTML edit failed: {e}. Falling back to plain text.")
+        
+        try:
+            await self.bot.edit_message_text(
+                chat_id=message.chat_id,
+                message_id=message.message_id,
+                text=text
+            )
+        except Exception as fallback_error:
+            logger.error(f"Failed to edit message even as plain text: {fallback_error}")
+    
     async def _generate_analysis(
         self,
         text: str,
@@ -381,68 +920,166 @@ Provide a ONE SENTENCE summary (max 150 characters) explaining the KEY concept o
             AI-generated analysis text
         """
         try:
-            # Build context-aware system prompt
             chapter_context = f" from chapter '{chapter}'" if chapter else ""
+            highlight = _ANALYSIS_HIGHLIGHT_PROMPT.format(book=book, author=author, chapter_context=chapter_context, text=text)
+            
+            # Only the highlight is sent per call; the static instructions go as the
+            # system instruction
+            analysis = await self._generate_text(
+                self.text_model,
+                highlight,
+                system_instruction=_ANALYSIS_SYSTEM_INSTRUCTION
+            )
+            if not analysis:
+                logger.warning("Empty response from Gemini for text analysis")
+                return "I apologize, but I couldn't generate an analysis at this time. Please try again later."
+            
+            return analysis
             
-            system_prompt = f"""You are an expert reading companion specializing in technical, engineering, and scientific literature (but also knowledgeable about general topics).
+        except Exception as e:
+            logger.error(f"Error generating AI analysis: {e}", exc_info=True)
+            return f"I encountered an error while analyzing this passage. Please try again later."
 
-The user is currently reading "{book}" by {author}{chapter_context}.
+    def _parse_analysis_json(self, response_text: str) -> Optional[dict]:
+        """
+        Parse the JSON object returned by the combined analysis/diagram prompt.
 
-They've highlighted the following passage:
+        Handles:
+        - Bare JSON
+        - JSON wrapped in markdown code fences (```json ... ```)
+        - JSON surrounded by stray prose (extracted with a regex)
 
-"{text}"
+        Args:
+            response_text: AI response text that should contain a JSON object
 
-Provide insightful analysis that:
-1. **Explains key concepts clearly** - Break down technical terms, principles, or ideas
-2. **Provides practical context** - How does this apply in real-world scenarios?
-3. **Connects to broader themes** - How does this relate to the book's main topics or the field in general?
-4. **Offers actionable insights** - What should the reader take away or explore further?
+        Returns:
+            Parsed dict or None if no JSON object could be recovered
+        """
+        cleaned = _JSON_FENCE_RE.sub("", response_text).strip()
+        try:
+            data = orjson.loads(cleaned)
+        except orjson.JSONDecodeError:
+            # Fall back to the outermost {...} span in the response
+            match = _JSON_OBJECT_RE.search(cleaned)
+            if not match:
+                return None
+            try:
+                data = orjson.loads(match.group(0))
+            except orjson.JSONDecodeError:
+                return None
 
-Keep your response:
-- Concise (2-3 paragraphs max)
-- Technically accurate when dealing with engineering/scientific content
-- Conversational and genuinely helpful
-- Focused on practical understanding
+        return data if isinstance(data, dict) else None
 
-If this is a technical/engineering book, focus on concepts, applications, and principles.
-If it's fiction or non-technical, provide literary or thematic analysis instead."""
+    async def _generate_analysis_and_diagram(
+        self,
+        text: str,
+        book: str,
+        author: str,
+        chapter: Optional[str] = None
+    ) -> Tuple[str, Optional[str]]:
+        """
+        Generate AI text analysis and decide on a Mermaid diagram in a single Gemini call.
 
-            # Generate response using Gemini text model (run in thread pool to avoid blocking event loop)
-            response = await asyncio.to_thread(
-                self.client.models.generate_content,
-                model=self.text_model,
-                contents=system_prompt
+        Used on the Mermaid path for passages that pass _likely_needs_diagram, instead of
+        a separate "should I draw a diagram?" round-trip. Gemini returns a JSON object
+        with keys `analysis`, `needs_diagram` and `mermaid_code`.
+
+        Args:
+            text: The highlighted text
+            book: Book title
+            author: Author name
+            chapter: Chapter name (optional)
+
+        Returns:
+            Tuple of (analysis text, Mermaid code or None if no diagram is needed)
+        """
+        try:
+            chapter_context = f" from chapter '{chapter}'" if chapter else ""
+
+            prompt = _ANALYSIS_AND_DIAGRAM_PROMPT.format(book=book, author=author, chapter_context=chapter_context, text=text)
+
+            # Repeated highlights are served from the response cache
+            response_text = await self._generate_text(
+                self.text_model,
+                prompt,
+                config=types.GenerateContentConfig(response_mime_type="application/json"),
+                system_instruction=_ANALYSIS_SYSTEM_INSTRUCTION
             )
-            
-            if not response or not response.text:
-                logger.warning("Empty response from Gemini for text analysis")
-                return "I apologize, but I couldn't generate an analysis at this time. Please try again later."
-            
-            return response.text.strip()
-            
+
+            if not response_text:
+                logger.warning("Empty response from Gemini for combined analysis")
+                return "I apologize, but I couldn't generate an analysis at this time. Please try again later.", None
+
+            data = self._parse_analysis_json(response_text)
+
+            if data is None:
+                # Gemini ignored the JSON format - treat the whole reply as the analysis
+                logger.warning(f"Could not parse combined analysis JSON. Response: {response_text[:200]}")
+                return response_text, None
+
+            analysis = str(data.get("analysis") or "").strip()
+            if not analysis:
+                logger.warning("Combined analysis JSON has no analysis text")
+                analysis = "I apologize, but I couldn't generate an analysis at this time. Please try again later."
+
+            mermaid_code = None
+            raw_code = data.get("mermaid_code")
+            if data.get("needs_diagram") and isinstance(raw_code, str) and raw_code.strip():
+                mermaid_code = self._extract_mermaid_code(raw_code.strip())
+                if mermaid_code:
+                    logger.info(f"✅ Generated Mermaid code ({len(mermaid_code)} chars)")
+                else:
+                    logger.warning(f"No valid Mermaid code found in response: {raw_code[:200]}")
+
+            return analysis, mermaid_code
+
         except Exception as e:
-            logger.error(f"Error generating AI analysis: {e}", exc_info=True)
-            return f"I encountered an error while analyzing this passage. Please try again later."
+            logger.error(f"Error generating combined analysis: {e}", exc_info=True)
+            return "I encountered an error while analyzing this passage. Please try again later.", None
+
+    def _likely_needs_diagram(self, text: str, book: str) -> bool:
+        """
+        Cheap local check for whether a highlight could benefit from a diagram.
+        
+        Filters out obvious no-ops (short quotes, fiction, verse, tables) before
+        spending a Gemini call on the "should I draw a diagram?" decision.
+        
+        Args:
+            text: The highlighted text
+            book: Book title
+            
+        Returns:
+            False if a diagram is clearly not useful, True if Gemini should decide
+        """
+        if len(text) < _MIN_DIAGRAM_TEXT_LEN:
+            return False
+        
+        if not (_DIAGRAM_HINT_RE.search(text) or _DIAGRAM_HINT_RE.search(book)):
+            return False
+        
+        # Lots of punctuation/whitespace relative to words usually means verse or a table
+        non_alnum = sum(1 for c in text if not c.isalnum())
+        if non_alnum > len(text) * _MAX_NON_ALNUM_RATIO:
+            return False
+        
+        return True
     
     async def _try_generate_image(
         self,
         text: str,
         book: str,
-        author: str,
-        analysis: str
+        author: str
     ) -> Optional[bytes]:
         """
-        Attempt to generate a helpful diagram for the highlighted text.
+        Attempt to generate a helpful diagram for the highlighted text with a direct
+        image model (gemini-2.5-flash-image / Imagen).
         
-        Strategy depends on the model:
-        - If using gemini-2.5-flash-image: Direct image generation (photorealistic/artistic)
-        - Otherwise: Generate Mermaid code → Convert to PNG (technical diagrams)
+        The Mermaid path decides on its diagram in _generate_analysis_and_diagram instead.
         
         Args:
             text: The highlighted text
             book: Book title
             author: Author name
-            analysis: The text analysis already generated
             
         Returns:
             Image bytes (PNG) if generated, None otherwise
@@ -451,22 +1088,20 @@ If it's fiction or non-technical, provide literary or thematic analysis instead.
             logger.info("Image generation disabled (GEMINI_IMAGE_MODEL not set)")
             return None
         
-        logger.info(f"🎨 Image generation enabled. Model: {self.image_model}")
+        # Skip the Gemini round-trip for passages that obviously don't need a diagram
+        if not self._likely_needs_diagram(text, book):
+            logger.info("Skipping image generation - passage doesn't look diagrammable")
+            return None
         
-        # Determine approach based on model
-        if "2.5-flash-image" in self.image_model.lower() or "imagen" in self.image_model.lower():
-            logger.info("Using direct image generation approach (Gemini 2.5 Flash Image)")
-            return await self._generate_direct_image(text, book, author, analysis)
-        else:
-            logger.info("Using Mermaid diagram approach (text model → mermaid.ink)")
-            return await self._generate_mermaid_diagram(text, book, author, analysis)
+        logger.info(f"🎨 Image generation enabled. Model: {self.image_model}")
+        logger.info("Using direct image generation approach (Gemini 2.5 Flash Image)")
+        return await self._generate_direct_image(text, book, author)
     
     async def _generate_direct_image(
         self,
         text: str,
         book: str,
-        author: str,
-        analysis: str
+        author: str
     ) -> Optional[bytes]:
         """
         Generate image directly using Gemini 2.5 Flash Image or Imagen.
@@ -474,26 +1109,10 @@ If it's fiction or non-technical, provide literary or thematic analysis instead.
         """
         try:
             # Prompt for technical diagram generation
-            image_prompt = f"""Based on this highlighted text from "{book}" by {author}:
-
-"{text}"
-
-Analysis: {analysis[:300]}...
-
-Create a clean, professional technical diagram that illustrates this concept. The diagram should:
-- Be simple and clear
-- Use a whiteboard or technical drawing style
-- Include labeled components
-- Be easy to understand at a glance
-- Focus on the core concept
-
-Only generate an image if this concept would genuinely benefit from visualization (system architectures, data flows, algorithms, etc.).
-
-If a diagram wouldn't add value, respond with text "SKIP" instead."""
+            image_prompt = _DIRECT_IMAGE_PROMPT.format(book=book, author=author, text=text)
 
             # Generate image using Gemini 2.5 Flash Image
-            response = await asyncio.to_thread(
-                self.client.models.generate_content,
+            response = await self._generate_content(
                 model=self.image_model,
                 contents=image_prompt
             )
@@ -508,8 +1127,8 @@ If a diagram wouldn't add value, respond with text "SKIP" instead."""
                     logger.info(f"✅ Image generated successfully by {self.image_model}")
                     return part.inline_data.data
             
-            # Check if Gemini decided to skip
-            if response.text and "SKIP" in response.text.upper():
+            # Check if Gemini decided to skip (only the start of the text can hold the marker)
+            if response.text and "SKIP" in response.text[:32].upper():
                 logger.info("Gemini decided this concept doesn't need a visual")
                 return None
             
@@ -537,146 +1156,270 @@ If a diagram wouldn't add value, respond with text "SKIP" instead."""
         """
         mermaid_code = None
         
-        # Try extracting from markdown code block (```mermaid)
-        if "```mermaid" in response_text:
-            start = response_text.find("```mermaid") + 10
-            end = response_text.find("```", start)
-            if end > start:
-                mermaid_code = response_text[start:end].strip()
+        match = _MERMAID_BLOCK_RE.search(response_text)
+        if match:
+            potential_code = match.group(2).strip()
+            if match.group(1):
+                # ```mermaid block
+                mermaid_code = potential_code
                 logger.info("Extracted Mermaid code from markdown block")
-        
-        # Try extracting from plain ``` block
-        elif "```" in response_text:
-            start = response_text.find("```") + 3
-            # Skip language identifier if present
-            newline_pos = response_text.find("\n", start)
-            if newline_pos > start:
-                start = newline_pos + 1
-            end = response_text.find("```", start)
-            if end > start:
-                potential_code = response_text[start:end].strip()
-                # Verify it looks like Mermaid
-                if any(keyword in potential_code for keyword in ["graph", "flowchart", "sequenceDiagram", "classDiagram", "stateDiagram", "erDiagram"]):
-                    mermaid_code = potential_code
-                    logger.info("Extracted Mermaid code from plain code block")
+            elif _MERMAID_KEYWORD_RE.search(potential_code):
+                # Plain ``` block - verify it looks like Mermaid
+                mermaid_code = potential_code
+                logger.info("Extracted Mermaid code from plain code block")
         
         # Try raw Mermaid code without markdown
-        if not mermaid_code and any(response_text.startswith(keyword) for keyword in ["graph", "flowchart", "sequenceDiagram", "classDiagram", "stateDiagram", "erDiagram"]):
+        if not mermaid_code and response_text.startswith(_MERMAID_KEYWORDS):
             mermaid_code = response_text
             logger.info("Using raw Mermaid code (no markdown wrapper)")
         
         return mermaid_code
     
-    async def _render_mermaid_to_png(self, mermaid_code: str) -> Optional[bytes]:
+    async def _render_mermaid_to_png(self, mermaid_code: str) -> Optional[bytes]:
+        """
+        Render Mermaid diagram code to PNG image.
+        
+        Uses the local mermaid-cli when MERMAID_LOCAL_RENDER is enabled,
+        falling back to the mermaid.ink service.
+        
+        Args:
+            mermaid_code: Valid Mermaid diagram code
+            
+        Returns:
+            PNG image bytes or None if rendering fails
+        """
+        if self._mermaid_local_render:
+            image_bytes = await self._render_mermaid_locally(mermaid_code)
+            if image_bytes:
+                return image_bytes
+            logger.info("Local Mermaid render failed, falling back to mermaid.ink")
+        
+        # Circuit breaker: don't hammer mermaid.ink while it's down
+        if time.monotonic() < self._mermaid_cooldown_until:
+            logger.info("Skipping Mermaid render - mermaid.ink is cooling down after repeated failures")
+            return None
+        
+        try:
+            logger.info(f"Rendering Mermaid code ({len(mermaid_code)} chars)")
+            logger.info(f"Mermaid code preview: {mermaid_code[:200]}...")
+            
+            # Convert Mermaid code to image using mermaid.ink
+            # This is a free public service that renders Mermaid diagrams
+            # Use URL-safe base64 encoding (replace + with - and / with _), without
+            # the padding (= characters) mermaid.ink doesn't expect - stripped on
+            # the bytes so only one str is built
+            encoded_mermaid = base64.urlsafe_b64encode(mermaid_code.encode('utf-8')).rstrip(b'=').decode('ascii')
+            mermaid_url = "https://mermaid.ink/img/" + encoded_mermaid
+            
+            logger.info(f"Requesting image from mermaid.ink: {mermaid_url[:100]}...")
+            
+            # Download the rendered image over the shared keep-alive session
+            session = self._get_session()
+            async with session.get(mermaid_url) as resp:
+                if resp.status == 200:
+                    # Stream the body with a hard cap so a runaway response can't balloon memory
+                    if resp.content_length and resp.content_length > _MERMAID_MAX_IMAGE_BYTES:
+                        logger.warning(f"Mermaid image too large ({resp.content_length} bytes), skipping")
+                        return None
+                    buf = bytearray()
+                    async for chunk in resp.content.iter_chunked(_MERMAID_READ_CHUNK_BYTES):
+                        buf += chunk
+                        if len(buf) > _MERMAID_MAX_IMAGE_BYTES:
+                            logger.warning(f"Mermaid image exceeded {_MERMAID_MAX_IMAGE_BYTES} bytes, skipping")
+                            return None
+                    image_bytes = bytes(buf)
+                    self._mermaid_failures = 0
+                    logger.info(f"✅ Successfully rendered Mermaid diagram to PNG ({len(image_bytes)} bytes)")
+                    return image_bytes
+                else:
+                    # Only the start of the error page is logged, so don't read the rest
+                    error_text = (await resp.content.read(200)).decode('utf-8', errors='replace')
+                    logger.warning(f"Failed to render Mermaid diagram: HTTP {resp.status}")
+                    logger.warning(f"Response body: {error_text}")
+                    self._record_mermaid_failure()
+                    return None
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            logger.warning(f"mermaid.ink request failed: {e!r}")
+            self._record_mermaid_failure()
+            return None
+        except Exception as e:
+            logger.error(f"Error rendering Mermaid to PNG: {e}", exc_info=True)
+            return None
+    
+    async def _render_mermaid_locally(self, mermaid_code: str) -> Optional[bytes]:
+        """
+        Render Mermaid diagram code to PNG with a local mermaid-cli (mmdc) process.
+        
+        The code is piped through stdin and the PNG read back from stdout, so
+        nothing touches the filesystem and no network round trip is needed.
+        
+        Args:
+            mermaid_code: Valid Mermaid diagram code
+            
+        Returns:
+            PNG image bytes or None if mmdc is missing or fails
+        """
+        async with self._mmdc_sem:
+            proc = None
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    "mmdc", "-i", "-", "-o", "-", "--outputFormat", "png",
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                stdout, stderr = await asyncio.wait_for(
+                    proc.communicate(mermaid_code.encode('utf-8')),
+                    timeout=_MMDC_TIMEOUT_SECONDS
+                )
+                if proc.returncode != 0 or not stdout:
+                    logger.warning(f"mmdc exited with {proc.returncode}: {stderr[:200].decode('utf-8', errors='replace')}")
+                    return None
+                if len(stdout) > _MERMAID_MAX_IMAGE_BYTES:
+                    logger.warning(f"Local Mermaid image too large ({len(stdout)} bytes), skipping")
+                    return None
+                logger.info(f"✅ Rendered Mermaid diagram locally ({len(stdout)} bytes)")
+                return stdout
+            except FileNotFoundError:
+                logger.warning("MERMAID_LOCAL_RENDER is enabled but mmdc was not found on PATH")
+                return None
+            except asyncio.TimeoutError:
+                logger.warning(f"mmdc timed out after {_MMDC_TIMEOUT_SECONDS}s")
+                if proc is not None and proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                return None
+            except Exception as e:
+                logger.error(f"Error rendering Mermaid locally: {e}", exc_info=True)
+                return None
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        """
+        Get the shared HTTP session, creating it on first use.
+        
+        Reusing one session keeps connections to mermaid.ink alive between
+        diagrams instead of paying a TCP+TLS handshake for each one.
+        
+        Returns:
+            Open aiohttp ClientSession
+        """
+        if self._http_session is None or self._http_session.closed:
+            self._http_session = aiohttp.ClientSession(
+                # Bound connect and read separately so a dead mermaid.ink fails fast
+                timeout=aiohttp.ClientTimeout(total=15, sock_connect=3, sock_read=10),
+                connector=aiohttp.TCPConnector(limit=20, ttl_dns_cache=300, keepalive_timeout=60)
+            )
+        return self._http_session
+    
+    async def close(self) -> None:
+        """Close the shared HTTP session. Call once on application shutdown."""
+        if self._http_session is not None and not self._http_session.closed:
+            await self._http_session.close()
+        self._http_session = None
+    
+    def _record_mermaid_failure(self) -> None:
+        """
+        Count a failed mermaid.ink request and open the circuit breaker
+        after too many consecutive failures.
         """
-        Render Mermaid diagram code to PNG image using mermaid.ink service.
+        self._mermaid_failures += 1
+        if self._mermaid_failures >= _MERMAID_MAX_FAILURES:
+            self._mermaid_cooldown_until = time.monotonic() + _MERMAID_COOLDOWN_SECONDS
+            self._mermaid_failures = 0
+            logger.warning(
+                f"mermaid.ink failed {_MERMAID_MAX_FAILURES} times in a row, "
+                f"pausing diagram rendering for {_MERMAID_COOLDOWN_SECONDS}s"
+            )
+    
+    def _fire_and_forget(self, coro) -> asyncio.Task:
+        """
+        Run a coroutine in the background without awaiting it.
+        
+        Keeps a reference to the task until it finishes (so it isn't garbage
+        collected mid-flight) and logs any exception instead of dropping it.
         
         Args:
-            mermaid_code: Valid Mermaid diagram code
+            coro: Coroutine to run
             
         Returns:
-            PNG image bytes or None if rendering fails
+            The scheduled task
         """
-        try:
-            import base64
-            import aiohttp
-            
-            logger.info(f"Rendering Mermaid code ({len(mermaid_code)} chars)")
-            logger.info(f"Mermaid code preview: {mermaid_code[:200]}...")
-            
-            # Convert Mermaid code to image using mermaid.ink
-            # This is a free public service that renders Mermaid diagrams
-            # Use URL-safe base64 encoding (replace + with - and / with _)
-            encoded_mermaid = base64.urlsafe_b64encode(mermaid_code.encode('utf-8')).decode('utf-8')
-            # Remove padding (= characters) as mermaid.ink doesn't expect them
-            encoded_mermaid = encoded_mermaid.rstrip('=')
-            mermaid_url = "https://mermaid.ink/img/" + encoded_mermaid
-            
-            logger.info(f"Requesting image from mermaid.ink: {mermaid_url[:100]}...")
-            
-            # Download the rendered image
-            async with aiohttp.ClientSession() as session:
-                async with session.get(mermaid_url, timeout=aiohttp.ClientTimeout(total=15)) as resp:
-                    if resp.status == 200:
-                        image_bytes = await resp.read()
-                        logger.info(f"✅ Successfully rendered Mermaid diagram to PNG ({len(image_bytes)} bytes)")
-                        return image_bytes
-                    else:
-                        error_text = await resp.text()
-                        logger.warning(f"Failed to render Mermaid diagram: HTTP {resp.status}")
-                        logger.warning(f"Response body: {error_text[:200]}")
-                        return None
-        except Exception as e:
-            logger.error(f"Error rendering Mermaid to PNG: {e}", exc_info=True)
-            return None
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._on_background_task_done)
+        return task
     
-    async def _generate_mermaid_diagram(
-        self,
-        text: str,
-        book: str,
-        author: str,
-        analysis: str
-    ) -> Optional[bytes]:
+    def _on_background_task_done(self, task: asyncio.Task) -> None:
+        """Drop the finished task and log its failure, if any."""
+        self._background_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.warning(f"Background task failed: {task.exception()}")
+    
+    async def _enqueue(self, chat_id: int, coro: Awaitable[None]) -> None:
         """
-        Generate Mermaid diagram code and convert to PNG.
-        Best for technical diagrams, flowcharts, system architectures.
+        Queue a handler coroutine on its chat's worker.
+        
+        Updates within one chat are processed in order, while different
+        chats are drained by independent workers and run in parallel.
+        
+        Args:
+            chat_id: Telegram chat ID the update belongs to
+            coro: Handler coroutine to run
         """
+        queue = self._chat_queues.get(chat_id)
+        if queue is None:
+            queue = self._chat_queues[chat_id] = asyncio.Queue()
+        queue.put_nowait(coro)
+        
+        if chat_id not in self._chat_workers:
+            self._chat_workers[chat_id] = self._fire_and_forget(self._drain_chat_queue(chat_id, queue))
+    
+    async def _drain_chat_queue(self, chat_id: int, queue: asyncio.Queue) -> None:
+        """Run queued handlers for one chat sequentially, exiting once the queue is empty."""
         try:
-            # Ask Gemini to generate Mermaid diagram code
-            mermaid_prompt = f"""Based on this highlighted text from "{book}" by {author}:
-
-"{text}"
-
-Analysis: {analysis[:300]}...
-
-**Task**: Determine if this concept would benefit from a visual diagram. If YES, generate valid Mermaid diagram code.
-
-Generate Mermaid code ONLY if it would genuinely help understanding:
-- System architectures
-- Data structures
-- Algorithms / Flowcharts
-- Workflows / Processes
-- Comparisons / Relationships
-- Database schemas
-
-If a diagram would help, respond with ONLY the Mermaid code (starting with ```mermaid).
-If visualization wouldn't add value, respond with exactly: "SKIP"
-
-Keep the diagram simple, clear, and focused on the core concept."""
-
-            # Generate Mermaid code using text model (Mermaid is text-based diagram code)
-            response = await asyncio.to_thread(
-                self.client.models.generate_content,
-                model=self.text_model,  # Use text_model for generating text-based diagram code
-                contents=mermaid_prompt
-            )
-            
-            if not response or not response.text:
-                logger.info("No response from Gemini for diagram generation")
-                return None
-            
-            response_text = response.text.strip()
-            
-            # Check if Gemini decided to skip
-            if response_text.upper() == "SKIP" or "SKIP" in response_text.upper()[:20]:
-                logger.info("Gemini decided this concept doesn't need a diagram")
-                return None
-            
-            # Extract Mermaid code using helper
-            mermaid_code = self._extract_mermaid_code(response_text)
-            
-            if not mermaid_code:
-                logger.warning(f"No valid Mermaid code found in response. Full response: {response_text[:500]}")
-                return None
-            
-            logger.info(f"✅ Generated Mermaid code ({len(mermaid_code)} chars)")
-            
-            # Render Mermaid code to PNG using helper
-            return await self._render_mermaid_to_png(mermaid_code)
+            while not queue.empty():
+                coro = queue.get_nowait()
+                try:
+                    await coro
+                except Exception as e:
+                    logger.error(f"Error handling update for chat {chat_id}: {e}", exc_info=True)
+                finally:
+                    queue.task_done()
+        finally:
+            # No await between the empty check and here, so nothing can be enqueued unseen
+            self._chat_workers.pop(chat_id, None)
+            if queue.empty():
+                self._chat_queues.pop(chat_id, None)
+    
+    def queued(
+        self,
+        handler: Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]
+    ) -> Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]:
+        """
+        Wrap a handler so it runs on its chat's queue instead of inline.
+        
+        The wrapper returns as soon as the update is queued, so the webhook
+        request isn't held up by slow Gemini work. Updates from chats other than
+        the configured one are dropped here, before any queue or worker is made.
+        
+        Trade-off: updates in the configured chat are answered strictly in order,
+        so a slow request (e.g. a photo analysis) delays the next question in that
+        chat until it finishes, rather than replies arriving out of order.
+        
+        Args:
+            handler: Update handler to wrap
             
-        except Exception as e:
-            logger.error(f"Error generating diagram: {e}", exc_info=True)
-            return None
+        Returns:
+            Handler suitable for registering with a MessageHandler
+        """
+        async def enqueue_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+            chat = update.effective_chat
+            if not chat or chat.id != self._chat_id_int:
+                logger.debug(f"Ignoring update from chat {chat.id if chat else None}")
+                return
+            await self._enqueue(chat.id, handler(update, context))
+        
+        return enqueue_update
     
     async def handle_general_question(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
@@ -689,48 +1432,54 @@ Keep the diagram simple, clear, and focused on the core concept."""
             update: Telegram update object
             context: Telegram context object
         """
-        if not update.message or not update.message.text:
+        msg = update.message
+        if not msg or not msg.text:
             return
         
+        chat_id = update.effective_chat.id
+        bot = context.bot
+        
         # Ignore messages not in the configured chat
-        if str(update.effective_chat.id) != self.chat_id:
-            logger.debug(f"Ignoring message from chat {update.effective_chat.id}")
+        if chat_id != self._chat_id_int:
+            logger.debug(f"Ignoring message from chat {chat_id}")
             return
         
         # Ignore the bot's own messages
-        if update.message.from_user.is_bot:
+        if msg.from_user.is_bot:
             logger.debug("Ignoring bot's own message")
             return
         
         # Check if the bot is mentioned/tagged in the message
-        bot_username = context.bot.username
-        message_text = update.message.text
+        bot_username = bot.username
+        message_text = msg.text
+        
+        mention_token = f"@{bot_username}" if bot_username else None
         
-        # Check for bot mention (either @username or entity mention)
+        # Check for bot mention (either @username or entity mention) and extract the
+        # question in the same pass by cutting the matched mention out of the text
         has_mention = False
-        if update.message.entities:
-            for entity in update.message.entities:
+        user_question = message_text
+        if msg.entities:
+            for entity in msg.entities:
                 if entity.type == "mention":
-                    mention = message_text[entity.offset:entity.offset + entity.length]
-                    if bot_username and mention == f"@{bot_username}":
+                    end = entity.offset + entity.length
+                    if mention_token and message_text[entity.offset:end] == mention_token:
                         has_mention = True
+                        user_question = message_text[:entity.offset] + message_text[end:]
                         break
-                elif entity.type == "text_mention" and entity.user.id == context.bot.id:
+                elif entity.type == "text_mention" and entity.user.id == bot.id:
                     has_mention = True
                     break
-        
-        # Also check for plain text mention
-        if bot_username and f"@{bot_username}" in message_text:
+        elif mention_token and mention_token in message_text:
+            # Telegram didn't send entities - fall back to a plain text mention
             has_mention = True
+            user_question = message_text.replace(mention_token, "")
         
         if not has_mention:
             logger.debug("Bot not mentioned in message, ignoring")
             return
         
-        # Extract the question (remove the bot mention)
-        user_question = message_text
-        if bot_username:
-            user_question = user_question.replace(f"@{bot_username}", "").strip()
+        user_question = user_question.strip()
         
         if not user_question:
             logger.debug("Empty question after removing mention, ignoring")
@@ -738,45 +1487,57 @@ Keep the diagram simple, clear, and focused on the core concept."""
         
         logger.info(f"Received general question from user {update.effective_user.id}: {user_question[:50]}...")
         
-        # Send typing indicator
-        await context.bot.send_chat_action(
-            chat_id=update.effective_chat.id,
-            action="typing"
+        # Send typing indicator while the response is generated (it's cosmetic,
+        # so a failure there is ignored)
+        _, response = await asyncio.gather(
+            bot.send_chat_action(
+                chat_id=chat_id,
+                action="typing"
+            ),
+            self.generate_general_answer(user_question),
+            return_exceptions=True
         )
+        if isinstance(response, BaseException):
+            raise response
         
-        # Generate response to general question
-        response = await self.generate_general_answer(user_question)
+        # If the user wants a visual/diagram, start generating it now so it
+        # overlaps with sending the text reply
+        image_task = None
+        if _wants_visual_explanation(user_question):
+            logger.info("User requested visual explanation, generating image...")
+            # The upload indicator is purely cosmetic - don't wait for it
+            self._fire_and_forget(bot.send_chat_action(
+                chat_id=chat_id,
+                action="upload_photo"
+            ))
+            
+            # Generate image based on the question and answer
+            image_task = asyncio.create_task(self._try_generate_image_from_text(
+                question=user_question,
+                answer=response
+            ))
         
         # Reply to the user's message using safe send method
         reply_msg = await self._safe_send_message(
-            chat_id=update.effective_chat.id,
+            chat_id=chat_id,
             text=f"🤖 {response}",
-            reply_to_message_id=update.message.message_id
+            reply_to_message_id=msg.message_id
         )
         
         if not reply_msg:
             logger.error("Failed to send response message")
+            if image_task:
+                image_task.cancel()
             return
         
-        # Check if user wants a visual/diagram
-        if self._wants_visual_explanation(user_question):
-            logger.info("User requested visual explanation, generating image...")
-            await context.bot.send_chat_action(
-                chat_id=update.effective_chat.id,
-                action="upload_photo"
-            )
-            
-            # Generate image based on the question and answer
-            image_bytes = await self._try_generate_image_from_text(
-                question=user_question,
-                answer=response
-            )
+        if image_task:
+            image_bytes = await image_task
             
             if image_bytes:
                 try:
-                    await context.bot.send_photo(
-                        chat_id=update.effective_chat.id,
-                        photo=io.BytesIO(image_bytes),
+                    await bot.send_photo(
+                        chat_id=chat_id,
+                        photo=image_bytes,
                         caption="🎨 Visual explanation",
                         reply_to_message_id=reply_msg.message_id
                     )
@@ -796,74 +1557,81 @@ Keep the diagram simple, clear, and focused on the core concept."""
             update: Telegram update object
             context: Telegram context object
         """
-        if not update.message or not update.message.text:
+        msg = update.message
+        if not msg or not msg.text:
             return
         
+        chat_id = update.effective_chat.id
+        bot = context.bot
+        
         # Ignore messages not in the configured chat
-        if str(update.effective_chat.id) != self.chat_id:
-            logger.debug(f"Ignoring message from chat {update.effective_chat.id}")
+        if chat_id != self._chat_id_int:
+            logger.debug(f"Ignoring message from chat {chat_id}")
             return
         
         # Ignore the bot's own messages
-        if update.message.from_user.is_bot:
+        if msg.from_user.is_bot:
             logger.debug("Ignoring bot's own message")
             return
         
         # Only respond to replies to the bot's messages
-        if not update.message.reply_to_message:
+        if not msg.reply_to_message:
             logger.debug("Message is not a reply, ignoring")
             return
         
         # Check if the reply is to the bot's message
-        if update.message.reply_to_message.from_user.id != context.bot.id:
+        if msg.reply_to_message.from_user.id != bot.id:
             logger.debug("Reply is not to bot's message, ignoring")
             return
         
-        user_question = update.message.text
-        previous_context = update.message.reply_to_message.text
+        user_question = msg.text
+        previous_context = msg.reply_to_message.text
         
         logger.info(f"Received follow-up question from user {update.effective_user.id}")
         
-        # Send typing indicator
-        await context.bot.send_chat_action(
-            chat_id=update.effective_chat.id,
-            action="typing"
-        )
-        
-        # Generate follow-up response
-        follow_up_response = await self._generate_follow_up(user_question, previous_context)
+        # If the user wants a visual/diagram, start generating it as soon as the
+        # answer is complete so it overlaps with the final edit of the reply
+        generate_image = None
+        if _wants_visual_explanation(user_question):
+            async def generate_image(answer: str) -> Optional[bytes]:
+                logger.info("User requested visual explanation, generating image...")
+                # The upload indicator is purely cosmetic - don't wait for it
+                self._fire_and_forget(bot.send_chat_action(
+                    chat_id=chat_id,
+                    action="upload_photo"
+                ))
+                
+                # Generate image based on the question and context
+                return await self._try_generate_image_from_text(
+                    question=user_question,
+                    answer=answer,
+                    context=previous_context
+                )
         
-        # Reply to the user's question using safe send method
-        reply_msg = await self._safe_send_message(
-            chat_id=update.effective_chat.id,
-            text=follow_up_response,
-            reply_to_message_id=update.message.message_id
+        # Stream the follow-up response into the reply as Gemini generates it
+        reply_msg, _, image_task = await self._stream_reply(
+            chat_id=chat_id,
+            model=self.text_model,
+            prompt=self._follow_up_prompt(user_question, previous_context),
+            reply_to_message_id=msg.message_id,
+            system_instruction=_FOLLOW_UP_SYSTEM_INSTRUCTION,
+            after_stream=generate_image
         )
         
         if not reply_msg:
             logger.error("Failed to send follow-up response message")
+            if image_task:
+                image_task.cancel()
             return
         
-        # Check if user wants a visual/diagram
-        if self._wants_visual_explanation(user_question):
-            logger.info("User requested visual explanation, generating image...")
-            await context.bot.send_chat_action(
-                chat_id=update.effective_chat.id,
-                action="upload_photo"
-            )
-            
-            # Generate image based on the question and context
-            image_bytes = await self._try_generate_image_from_text(
-                question=user_question,
-                answer=follow_up_response,
-                context=previous_context
-            )
+        if image_task:
+            image_bytes = await image_task
             
             if image_bytes:
                 try:
-                    await context.bot.send_photo(
-                        chat_id=update.effective_chat.id,
-                        photo=io.BytesIO(image_bytes),
+                    await bot.send_photo(
+                        chat_id=chat_id,
+                        photo=image_bytes,
                         caption="🎨 Visual explanation",
                         reply_to_message_id=reply_msg.message_id
                     )
@@ -886,19 +1654,40 @@ Keep the diagram simple, clear, and focused on the core concept."""
         try:
             # Get the highest resolution photo (last in the list)
             largest_photo = photo_sizes[-1]
-            logger.info(f"Downloading photo: {largest_photo.file_id} ({largest_photo.width}x{largest_photo.height})")
+            file_id = largest_photo.file_id
+            
+            cached = self._photo_cache.get(file_id)
+            if cached is not None:
+                self._photo_cache.move_to_end(file_id)
+                logger.info(f"Using cached photo: {file_id} ({len(cached)} bytes)")
+                return cached
+            
+            logger.info(f"Downloading photo: {file_id} ({largest_photo.width}x{largest_photo.height})")
             
-            # Download the file
-            file = await self.bot.get_file(largest_photo.file_id)
-            photo_bytes = await file.download_as_bytearray()
+            # Download the file. The result is cached and shared across requests,
+            # so it's frozen into immutable bytes rather than kept as a bytearray
+            file = await self.bot.get_file(file_id)
+            photo_bytes = bytes(await file.download_as_bytearray())
             
             logger.info(f"✅ Downloaded photo: {len(photo_bytes)} bytes")
-            return bytes(photo_bytes)
+            self._cache_photo(file_id, photo_bytes)
+            return photo_bytes
             
         except Exception as e:
             logger.error(f"Error downloading photo: {e}", exc_info=True)
             return None
     
+    def _cache_photo(self, file_id: str, photo_bytes: bytes) -> None:
+        """Store downloaded photo bytes, evicting least recently used photos over budget."""
+        if len(photo_bytes) > _PHOTO_CACHE_MAX_BYTES or file_id in self._photo_cache:
+            return
+        
+        self._photo_cache[file_id] = photo_bytes
+        self._photo_cache_bytes += len(photo_bytes)
+        while self._photo_cache_bytes > _PHOTO_CACHE_MAX_BYTES:
+            _, evicted = self._photo_cache.popitem(last=False)
+            self._photo_cache_bytes -= len(evicted)
+    
     async def handle_photo_question(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """
         Handle questions about photos sent to the bot.
@@ -913,55 +1702,63 @@ Keep the diagram simple, clear, and focused on the core concept."""
         """
         logger.info("📸 Photo message handler triggered")
         
-        if not update.message:
+        msg = update.message
+        if not msg:
             logger.debug("No message in update")
             return
         
+        chat_id = update.effective_chat.id
+        bot = context.bot
+        
         # Ignore messages not in the configured chat
-        if str(update.effective_chat.id) != self.chat_id:
-            logger.info(f"❌ Ignoring photo from wrong chat: {update.effective_chat.id} (expected: {self.chat_id})")
+        if chat_id != self._chat_id_int:
+            logger.info(f"❌ Ignoring photo from wrong chat: {chat_id} (expected: {self.chat_id})")
             return
         
         # Ignore the bot's own messages
-        if update.message.from_user.is_bot:
+        if msg.from_user.is_bot:
             logger.debug("Ignoring bot's own message")
             return
         
         # Check if there's a photo
-        if not update.message.photo:
+        if not msg.photo:
             logger.debug("No photo in message, ignoring")
             return
         
         logger.info(f"✅ Photo message received from user {update.effective_user.id} in correct chat")
         
         # Check if the bot is mentioned in the caption
-        bot_username = context.bot.username
-        caption = update.message.caption or ""
+        bot_username = bot.username
+        mention_token = f"@{bot_username}" if bot_username else None
+        caption = msg.caption or ""
         
         has_mention = False
-        if update.message.caption_entities:
-            for entity in update.message.caption_entities:
+        if msg.caption_entities:
+            for entity in msg.caption_entities:
                 if entity.type == "mention":
                     mention = caption[entity.offset:entity.offset + entity.length]
-                    if bot_username and mention == f"@{bot_username}":
+                    if mention_token and mention == mention_token:
                         has_mention = True
                         break
-                elif entity.type == "text_mention" and entity.user.id == context.bot.id:
+                elif entity.type == "text_mention" and entity.user.id == bot.id:
                     has_mention = True
                     break
         
-        # Also check for plain text mention
-        if bot_username and f"@{bot_username}" in caption:
+        # Also check for plain text mention (only needed if the entities didn't match)
+        if not has_mention and mention_token and mention_token in caption:
             has_mention = True
         
         if not has_mention:
             logger.debug("Bot not mentioned in photo caption, ignoring")
             return
         
-        # Extract the question (remove the bot mention)
+        # Extract the question (remove the bot mention) in a single scan
         user_question = caption
-        if bot_username:
-            user_question = user_question.replace(f"@{bot_username}", "").strip()
+        if mention_token:
+            before, sep, after = caption.partition(mention_token)
+            if sep:
+                user_question = before + after
+        user_question = user_question.strip()
         
         # If no question text, use a default prompt
         if not user_question:
@@ -969,19 +1766,23 @@ Keep the diagram simple, clear, and focused on the core concept."""
         
         logger.info(f"Received photo question from user {update.effective_user.id}: {user_question[:50]}...")
         
-        # Send typing indicator
-        await context.bot.send_chat_action(
-            chat_id=update.effective_chat.id,
-            action="typing"
+        # Send typing indicator while the photo downloads (it's cosmetic, so a
+        # failure there is ignored)
+        _, photo_bytes = await asyncio.gather(
+            bot.send_chat_action(
+                chat_id=chat_id,
+                action="typing"
+            ),
+            self._download_photo(msg.photo),
+            return_exceptions=True
         )
-        
-        # Download the photo
-        photo_bytes = await self._download_photo(update.message.photo)
+        if isinstance(photo_bytes, BaseException):
+            raise photo_bytes
         if not photo_bytes:
             await self._safe_send_message(
-                chat_id=update.effective_chat.id,
+                chat_id=chat_id,
                 text="Sorry, I couldn't download the image. Please try again.",
-                reply_to_message_id=update.message.message_id
+                reply_to_message_id=msg.message_id
             )
             return
         
@@ -990,9 +1791,9 @@ Keep the diagram simple, clear, and focused on the core concept."""
         
         # Reply to the user's message using safe send method
         reply_msg = await self._safe_send_message(
-            chat_id=update.effective_chat.id,
+            chat_id=chat_id,
             text=f"🤖 {response}",
-            reply_to_message_id=update.message.message_id
+            reply_to_message_id=msg.message_id
         )
         
         if not reply_msg:
@@ -1013,40 +1814,13 @@ Keep the diagram simple, clear, and focused on the core concept."""
             AI-generated analysis/answer
         """
         try:
-            # Convert image to base64
-            image_b64 = base64.b64encode(image_bytes).decode('utf-8')
-            
             # Determine image mime type (basic detection based on magic bytes)
-            mime_type = "image/jpeg"  # default
-            if image_bytes.startswith(b'\x89PNG'):
-                mime_type = "image/png"
-            elif image_bytes.startswith(b'GIF'):
-                mime_type = "image/gif"
-            elif image_bytes.startswith(b'RIFF') and image_bytes[8:12] == b'WEBP':
-                mime_type = "image/webp"
+            mime_type = _sniff_image_mime_type(image_bytes)
             
             logger.info(f"Analyzing image ({mime_type}, {len(image_bytes)} bytes) with question: {question[:100]}...")
             
             # Build prompt for vision analysis
-            prompt = f"""You are an expert assistant with vision capabilities, specializing in technical, engineering, and scientific content analysis.
-
-A user has shared an image and asked:
-"{question}"
-
-Analyze the image carefully and provide a thoughtful, detailed response that:
-1. **Describes what you see** - Key elements, structure, content
-2. **Answers their specific question** - Address exactly what they asked
-3. **Provides context and insights** - Explain technical concepts, patterns, or relationships you observe
-4. **Offers additional observations** - Share relevant details they might find interesting
-
-If the image contains:
-- Technical diagrams: Explain the architecture, flow, or components
-- Code/text: Analyze and explain the content
-- Charts/graphs: Interpret the data and trends
-- Documents: Summarize and explain key points
-- General photos: Describe and contextualize what's shown
-
-Be detailed, accurate, and genuinely helpful."""
+            prompt = _IMAGE_ANALYSIS_PROMPT.format(question=question)
 
             # Create multimodal content with image
             # Using the correct API: Part class methods should be called with keyword arguments
@@ -1061,8 +1835,7 @@ Be detailed, accurate, and genuinely helpful."""
             ]
             
             # Generate response using Gemini with vision
-            response = await asyncio.to_thread(
-                self.client.models.generate_content,
+            response = await self._generate_content(
                 model=self.text_model,  # gemini-3-flash-preview supports vision
                 contents=contents
             )
@@ -1078,29 +1851,6 @@ Be detailed, accurate, and genuinely helpful."""
             logger.error(f"Error analyzing image: {e}", exc_info=True)
             return "I encountered an error while analyzing the image. Please try again."
     
-    def _wants_visual_explanation(self, text: str) -> bool:
-        """
-        Check if the user is asking for a visual/diagram explanation.
-        
-        Args:
-            text: The user's message text
-            
-        Returns:
-            True if user wants a visual explanation
-        """
-        visual_keywords = [
-            "diagram", "diagrammatically", "diagrammatic",
-            "visualize", "visualise", "visual", "visually",
-            "draw", "drawing", "sketch",
-            "show", "illustrate", "illustration",
-            "chart", "graph", "flowchart",
-            "picture", "image",
-            "explain with", "show me"
-        ]
-        
-        text_lower = text.lower()
-        return any(keyword in text_lower for keyword in visual_keywords)
-    
     async def _try_generate_image_from_text(
         self,
         question: str,
@@ -1125,7 +1875,7 @@ Be detailed, accurate, and genuinely helpful."""
         logger.info(f"🎨 Generating visual for: {question[:100]}...")
         
         # Determine approach based on model
-        if "2.5-flash-image" in self.image_model.lower() or "imagen" in self.image_model.lower():
+        if self._image_mode == "direct":
             return await self._generate_direct_image_from_text(question, answer, context)
         else:
             return await self._generate_mermaid_from_text(question, answer, context)
@@ -1140,26 +1890,13 @@ Be detailed, accurate, and genuinely helpful."""
         Generate image directly using Gemini 2.5 Flash Image for general questions.
         """
         try:
-            context_text = f"\n\nPrevious context:\n{context[:300]}..." if context else ""
+            context_text = f"\n\nPrevious context:\n{_head(context)}..." if context else ""
             
             # Prompt for visual diagram generation
-            image_prompt = f"""User's question: "{question}"
-
-Text explanation provided:
-{answer[:500]}...{context_text}
-
-Create a clean, professional technical diagram or visual that illustrates this concept. The diagram should:
-- Be simple, clear, and easy to understand
-- Use a whiteboard or technical drawing style
-- Include labeled components and relationships
-- Focus on the core concept being explained
-- Use appropriate diagram type (flowchart, architecture, comparison, etc.)
-
-Make it visually informative and complement the text explanation."""
+            image_prompt = _DIRECT_IMAGE_FROM_TEXT_PROMPT.format(question=question, answer=_head(answer, 500), context_text=context_text)
 
             # Generate image using Gemini 2.5 Flash Image
-            response = await asyncio.to_thread(
-                self.client.models.generate_content,
+            response = await self._generate_content(
                 model=self.image_model,
                 contents=image_prompt
             )
@@ -1190,43 +1927,23 @@ Make it visually informative and complement the text explanation."""
         """
         Generate Mermaid diagram code from text and convert to PNG.
         
-        Note: Unlike _generate_mermaid_diagram, this method does NOT support SKIP responses
+        Note: Unlike the highlight diagram decision, this method does NOT support SKIP responses
         because it's called when the user explicitly requests a visual (e.g., "show me a diagram").
         We always attempt to generate a diagram when this method is invoked.
         """
         try:
-            context_text = f"\n\nPrevious context:\n{context[:300]}..." if context else ""
+            context_text = f"\n\nPrevious context:\n{_head(context)}..." if context else ""
             
             # Ask Gemini to generate Mermaid diagram code
-            mermaid_prompt = f"""User's question: "{question}"
-
-Text explanation:
-{answer[:500]}...{context_text}
-
-**Task**: Generate a Mermaid diagram that visually explains this concept.
-
-Create valid Mermaid code that:
-- Uses the appropriate diagram type (flowchart, sequenceDiagram, classDiagram, graph, etc.)
-- Is simple and focused on the core concept
-- Includes clear labels and relationships
-- Is technically accurate
-
-Respond with ONLY the Mermaid code (starting with the diagram type like "flowchart TD" or "graph LR").
-Do NOT include markdown code fences or explanations."""
+            mermaid_prompt = _MERMAID_FROM_TEXT_PROMPT.format(question=question, answer=_head(answer, 500), context_text=context_text)
 
             # Generate Mermaid code using text model (Mermaid is text-based diagram code)
-            response = await asyncio.to_thread(
-                self.client.models.generate_content,
-                model=self.text_model,  # Use text_model for generating text-based diagram code
-                contents=mermaid_prompt
-            )
+            response_text = await self._generate_text(self.text_model, mermaid_prompt)
             
-            if not response or not response.text:
+            if not response_text:
                 logger.info("No response from Gemini for diagram generation")
                 return None
             
-            response_text = response.text.strip()
-            
             # Extract Mermaid code using helper
             mermaid_code = self._extract_mermaid_code(response_text)
             
@@ -1258,117 +1975,50 @@ Do NOT include markdown code fences or explanations."""
         """
         try:
             # Check if user wants a visual - adjust prompt accordingly
-            wants_visual = self._wants_visual_explanation(question)
+            wants_visual = _wants_visual_explanation(question)
             visual_instruction = ""
             if wants_visual:
-                visual_instruction = "\n\n**IMPORTANT**: The user has requested a visual/diagram explanation. DO NOT create ASCII art or text-based diagrams in your response. Instead, describe the concept clearly in text - a proper visual diagram will be generated separately and sent after this message."
+                visual_instruction = _VISUAL_INSTRUCTION
             
-            prompt = f"""You are an expert assistant specializing in technical, engineering, and scientific topics, but also knowledgeable about general subjects.
-
-A user has asked you a question:
-{question}
-
-Provide a thoughtful, accurate response that:
-1. **Directly answers their question** with precision and clarity
-2. **Explains complex concepts simply** - Break down technical terms when needed
-3. **Provides practical context** - Include real-world examples or applications
-4. **Offers additional insights** - Share related information that might be helpful
-5. Is concise (2-3 paragraphs) but comprehensive
-
-If the question is about technical/engineering topics:
-- Use precise terminology but explain it clearly
-- Provide concrete examples or use cases
-- Suggest related concepts to explore
-
-If the question is about general topics:
-- Be informative and engaging
-- Provide relevant context and background
-- Share interesting connections or perspectives
-
-Be warm, knowledgeable, and genuinely helpful.{visual_instruction}"""
+            prompt = _GENERAL_ANSWER_PROMPT.format(question=question, visual_instruction=visual_instruction)
 
-            # Generate response using Gemini text model (run in thread pool to avoid blocking event loop)
-            response = await asyncio.to_thread(
-                self.client.models.generate_content,
-                model=self.text_model,
-                contents=prompt
-            )
+            # Generate response using Gemini text model (repeated prompts are served from cache)
+            response_text = await self._generate_text(self.text_model, prompt)
             
-            if not response or not response.text:
+            if not response_text:
                 logger.warning("Empty response from Gemini for general question")
                 return "I apologize, but I couldn't generate a response. Could you rephrase your question?"
             
-            return response.text.strip()
+            return response_text
             
         except Exception as e:
             logger.error(f"Error generating general answer: {e}", exc_info=True)
             return "I encountered an error. Please try asking again."
     
-    async def _generate_follow_up(self, question: str, previous_context: str) -> str:
+    def _follow_up_prompt(self, question: str, previous_context: str) -> str:
         """
-        Generate a follow-up response based on user's question and previous context.
-        Uses the text model for fast, high-quality responses.
+        Build the per-call follow-up prompt (sent with _FOLLOW_UP_SYSTEM_INSTRUCTION).
         
         Args:
             question: User's follow-up question
             previous_context: The previous message being replied to
             
         Returns:
-            AI-generated follow-up response
+            User turn text
         """
-        try:
-            # Check if user wants a visual - adjust prompt accordingly
-            wants_visual = self._wants_visual_explanation(question)
-            visual_instruction = ""
-            if wants_visual:
-                visual_instruction = "\n\n**IMPORTANT**: The user has requested a visual/diagram explanation. DO NOT create ASCII art or text-based diagrams in your response. Instead, describe the concept clearly in text - a proper visual diagram will be generated separately and sent after this message."
-            
-            prompt = f"""You are an expert reading companion specializing in technical, engineering, and scientific literature (but also knowledgeable about general topics).
-
-You're in a conversation with a reader about their book.
-
-Previous context:
-{previous_context}
-
-The reader's follow-up question:
-{question}
-
-Provide a thoughtful response that:
-1. **Directly answers their question** with technical accuracy
-2. **Builds on the previous context** - Reference what was already discussed
-3. **Offers deeper insights** - Go beyond the surface when appropriate
-4. **Suggests connections** - Link to related concepts, chapters, or real-world applications
-5. Is concise (2-3 paragraphs) but comprehensive
-
-If discussing technical/engineering topics:
-- Use precise terminology but explain it clearly
-- Provide practical examples or applications
-- Suggest related concepts to explore
-
-Be warm, knowledgeable, and genuinely helpful.{visual_instruction}"""
-
-            # Generate response using Gemini text model (run in thread pool to avoid blocking event loop)
-            response = await asyncio.to_thread(
-                self.client.models.generate_content,
-                model=self.text_model,
-                contents=prompt
-            )
-            
-            if not response or not response.text:
-                logger.warning("Empty response from Gemini for follow-up")
-                return "I apologize, but I couldn't generate a response. Could you rephrase your question?"
-            
-            return response.text.strip()
-            
-        except Exception as e:
-            logger.error(f"Error generating follow-up response: {e}", exc_info=True)
-            return "I encountered an error. Please try asking again."
+        # Check if user wants a visual - adjust prompt accordingly
+        visual_instruction = _VISUAL_INSTRUCTION if _wants_visual_explanation(question) else ""
+        return _FOLLOW_UP_PROMPT.format(previous_context=previous_context, question=question, visual_instruction=visual_instruction)
 
 
+@lru_cache(maxsize=1)
 def create_kobo_ai_companion() -> Optional[KoboAICompanion]:
     """
     Factory function to create KoboAICompanion from settings.
     
+    Cached so the API router and the Telegram application share one companion
+    (one Gemini client, one Bot, one set of caches) instead of building two.
+    
     Returns:
         KoboAICompanion instance if configured, None otherwise
     """
@@ -1395,11 +2045,12 @@ def create_kobo_ai_companion() -> Optional[KoboAICompanion]:
             image_model = None
         
         return KoboAICompanion(
-            telegram_token=settings.TELEGRAM_BOT_TOKEN.get_secret_value(),
+            bot=Bot(token=settings.TELEGRAM_BOT_TOKEN.get_secret_value()),
             gemini_api_key=settings.GEMINI_API_KEY.get_secret_value(),
             chat_id=settings.TELEGRAM_CHAT_ID,
             text_model=settings.GEMINI_MODEL,
-            image_model=image_model
+            image_model=image_model,
+            mermaid_local_render=settings.MERMAID_LOCAL_RENDER
         )
     except Exception as e:
         logger.error(f"Failed to create KoboAICompanion: {e}", exc_info=True)
@@ -1425,8 +2076,28 @@ class BotMentionFilter(filters.MessageFilter):
         """
         self.bot_username = bot_username
         self.bot_id = bot_id
+        # Built once here since filter() runs for every incoming message
+        self._mention_token = f"@{bot_username}"
+        self._min_len = len(self._mention_token)
+        # Entity type -> matcher, looked up once per entity in filter()
+        self._dispatch = {
+            "mention": self._match_mention,
+            "text_mention": self._match_text_mention,
+        }
+        self._short_dispatch = {"text_mention": self._match_text_mention}
         super().__init__()
     
+    def _match_mention(self, entity, text: str) -> bool:
+        """Check whether an @username mention entity is @bot_username."""
+        # Skip slicing mentions of other lengths
+        if entity.length != self._min_len:
+            return False
+        return text[entity.offset:entity.offset + entity.length] == self._mention_token
+    
+    def _match_text_mention(self, entity, text: str) -> bool:
+        """Check whether a text_mention (user without public username) refers to this bot by ID."""
+        return entity.user is not None and entity.user.id == self.bot_id
+    
     def filter(self, message):
         """
         Check if the message mentions this specific bot.
@@ -1438,9 +2109,6 @@ class BotMentionFilter(filters.MessageFilter):
             True if this bot is mentioned, False otherwise
         """
         # Check both text entities (for regular messages) and caption entities (for photos/media)
-        entities_to_check = []
-        text_to_check = ""
-        
         if message.entities:
             entities_to_check = message.entities
             text_to_check = message.text or ""
@@ -1450,17 +2118,13 @@ class BotMentionFilter(filters.MessageFilter):
         else:
             return False
         
+        # Too short to contain @bot_username - only a text_mention could still match
+        dispatch = self._dispatch if len(text_to_check) >= self._min_len else self._short_dispatch
+        
         for entity in entities_to_check:
-            # Check for @username mention
-            if entity.type == "mention":
-                mention_text = text_to_check[entity.offset:entity.offset + entity.length]
-                if mention_text == f"@{self.bot_username}":
-                    return True
-            # Check for text_mention (when user doesn't have a public username)
-            elif entity.type == "text_mention":
-                # Validate that the mention refers to this specific bot by ID
-                if entity.user and entity.user.id == self.bot_id:
-                    return True
+            matcher = dispatch.get(entity.type)
+            if matcher and matcher(entity, text_to_check):
+                return True
         
         return False
 
@@ -1480,19 +2144,20 @@ async def create_telegram_application() -> Optional[Application]:
         return None
     
     try:
-        # Create application for webhook mode
-        application = (
-            Application.builder()
-            .token(settings.TELEGRAM_BOT_TOKEN.get_secret_value())
-            .build()
-        )
-        
         # Create companion service
         companion = create_kobo_ai_companion()
         if not companion:
             logger.error("Failed to create KoboAICompanion")
             return None
         
+        # Create application for webhook mode around the companion's bot, so
+        # handlers and highlight sends share one Bot and one connection pool
+        application = (
+            Application.builder()
+            .bot(companion.bot)
+            .build()
+        )
+        
         # Get bot username and ID for the mention filter
         bot = application.bot
         bot_info = await bot.get_me()
@@ -1504,7 +2169,7 @@ async def create_telegram_application() -> Optional[Application]:
         application.add_handler(
             MessageHandler(
                 filters.PHOTO & BotMentionFilter(bot_username, bot_id),
-                companion.handle_photo_question
+                companion.queued(companion.handle_photo_question)
             )
         )
         
@@ -1513,7 +2178,7 @@ async def create_telegram_application() -> Optional[Application]:
         application.add_handler(
             MessageHandler(
                 filters.TEXT & ~filters.COMMAND & BotMentionFilter(bot_username, bot_id),
-                companion.handle_general_question
+                companion.queued(companion.handle_general_question)
             )
         )
         
@@ -1521,7 +2186,7 @@ async def create_telegram_application() -> Optional[Application]:
         application.add_handler(
             MessageHandler(
                 filters.TEXT & ~filters.COMMAND & filters.REPLY,
-                companion.handle_conversation
+                companion.queued(companion.handle_conversation)
             )
         )
         
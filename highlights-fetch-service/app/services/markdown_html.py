@@ -0,0 +1,92 @@
+"""
+Markdown to HTML conversion for Telegram HTML parse mode.
+Dependency-free so it can be used (and tested) without the bot's settings or clients.
+"""
+import html
+import re
+
+
+# Every Markdown construct in one alternation, so the text is scanned once.
+# Line-start constructs come first so "* item" is a bullet, not italics.
+_MARKDOWN_RE = re.compile(
+    r'(?P<heading>^#{1,6}\s+(?P<heading_text>.+)$)'
+    r'|(?P<bullet>^[\-\*\+]\s+)'
+    r'|(?P<numbered>^\d+\.\s+)'
+    r'|\*\*\*(?P<bold_italic>.+?)\*\*\*'
+    r'|\*\*(?P<bold>.+?)\*\*'
+    r'|__(?P<underline>.+?)__'
+    r'|\*(?P<italic>.+?)\*'
+    r'|(?<!\w)_(?P<italic_underscore>.+?)_(?!\w)'
+    r'|`(?P<code>.+?)`'
+    r'|\[(?P<link_text>.+?)\]\((?P<url>.+?)\)',
+    re.MULTILINE
+)
+
+# Characters that can start a Markdown construct; numbered list items are the one
+# construct without one, so they get their own (line-anchored) check
+_MARKDOWN_CHARS = '*_#`[-+'
+_NUMBERED_LINE_RE = re.compile(r'^\d+\.\s', re.MULTILINE)
+
+
+def _convert_match(match: re.Match) -> str:
+    """Render one Markdown construct as HTML, converting nested formatting inside it."""
+    kind = match.lastgroup
+    if kind == 'heading':
+        return f'<b>{_convert_inline(match.group("heading_text"))}</b>'
+    if kind == 'bullet':
+        return '• '
+    if kind == 'numbered':
+        return f'{match.group(0)} '
+    if kind == 'bold_italic':
+        return f'<b><i>{_convert_inline(match.group("bold_italic"))}</i></b>'
+    if kind == 'bold':
+        return f'<b>{_convert_inline(match.group("bold"))}</b>'
+    if kind == 'underline':
+        return f'<u>{_convert_inline(match.group("underline"))}</u>'
+    if kind in ('italic', 'italic_underscore'):
+        return f'<i>{_convert_inline(match.group(kind))}</i>'
+    if kind == 'code':
+        return f'<code>{match.group("code")}</code>'
+    # [link](url) - unescape the URL since it was escaped with the rest of the text
+    url = match.group('url').replace('&amp;', '&').replace('&lt;', '<').replace('&gt;', '>')
+    return f'<a href="{url}">{_convert_inline(match.group("link_text"))}</a>'
+
+
+def _convert_inline(text: str) -> str:
+    """Convert already-escaped Markdown text to HTML in a single pass."""
+    return _MARKDOWN_RE.sub(_convert_match, text)
+
+
+def markdown_to_html(text: str) -> str:
+    """
+    Convert common Markdown syntax to HTML tags for Telegram HTML parse mode.
+
+    The AI replies in Markdown, which Telegram's legacy Markdown parser often
+    rejects, so replies are converted to HTML before sending. It converts:
+    - ***bold italic*** → <b><i>bold italic</i></b>
+    - **bold** → <b>bold</b>
+    - *italic* → <i>italic</i>
+    - __underline__ → <u>underline</u>
+    - ### Heading → <b>Heading</b>
+    - `code` → <code>code</code>
+    - [link](url) → <a href="url">link</a>
+    - bullet and numbered list items
+
+    Formatting nested inside bold, italic, headings and links is converted too;
+    code spans are left as-is.
+
+    Args:
+        text: Text with Markdown syntax
+
+    Returns:
+        Text with HTML tags
+    """
+    # First, escape HTML special characters to avoid conflicts (most AI
+    # responses have none, and the membership checks are much cheaper)
+    if '&' in text or '<' in text or '>' in text:
+        text = html.escape(text, quote=False)
+
+    # Plain prose has nothing to convert - skip the regex pass entirely
+    if not any(c in text for c in _MARKDOWN_CHARS) and not _NUMBERED_LINE_RE.search(text):
+        return text
+    return _convert_inline(text)
@@ -5,7 +5,7 @@ Thread-safe in-memory storage for sync status tracking.
 import logging
 from datetime import datetime, timezone
 from enum import Enum
-from typing import Optional
+from typing import NamedTuple, Optional
 from threading import Lock
 
 logger = logging.getLogger(__name__)
@@ -20,109 +20,165 @@ class SyncStatus(str, Enum):
     ERROR = "error"
 
 
+# Fixed status messages, so transitions don't rebuild them
+_STATUS_MESSAGES = {
+    SyncStatus.IDLE: "",
+    SyncStatus.CHECKING: "Checking for updates...",
+    SyncStatus.DOWNLOADING: "Downloading database...",
+    SyncStatus.COMPLETED: "Sync completed",
+    SyncStatus.UP_TO_DATE: "Database is up to date",
+    SyncStatus.ERROR: "Sync failed",
+}
+
+# Statuses during which a sync is in progress (see is_busy)
+_BUSY_STATES = frozenset({SyncStatus.CHECKING, SyncStatus.DOWNLOADING})
+
+# Allowed status changes (see SyncState._transition). A new sync starts from IDLE,
+# and ERROR is reachable from anywhere so failures are always recorded.
+_TRANSITIONS = {
+    SyncStatus.IDLE: frozenset({SyncStatus.IDLE, SyncStatus.CHECKING, SyncStatus.ERROR}),
+    SyncStatus.CHECKING: frozenset({SyncStatus.DOWNLOADING, SyncStatus.UP_TO_DATE, SyncStatus.ERROR}),
+    SyncStatus.DOWNLOADING: frozenset({SyncStatus.COMPLETED, SyncStatus.ERROR}),
+    SyncStatus.COMPLETED: frozenset({SyncStatus.IDLE, SyncStatus.ERROR}),
+    SyncStatus.UP_TO_DATE: frozenset({SyncStatus.IDLE, SyncStatus.ERROR}),
+    SyncStatus.ERROR: frozenset({SyncStatus.IDLE, SyncStatus.ERROR}),
+}
+
+
+class _StateSnapshot(NamedTuple):
+    """Immutable view of the sync state, replaced as a whole on every update"""
+    status: SyncStatus
+    message: str
+    progress: Optional[float]  # 0-100 for future progress tracking
+    error: Optional[str]
+    last_sync_time: Optional[datetime]
+    last_sync_time_iso: Optional[str]  # Formatted once per completed sync
+    file_size_mb: Optional[float]
+
+
 class SyncState:
-    """Thread-safe singleton for tracking sync state"""
-    
-    _instance = None
-    _lock = Lock()
+    """
+    Thread-safe tracker for sync state. Use the module-level sync_state instance.
     
-    def __new__(cls):
-        if cls._instance is None:
-            with cls._lock:
-                if cls._instance is None:
-                    cls._instance = super().__new__(cls)
-                    cls._instance._initialized = False
-        return cls._instance
+    Setters serialize on a lock and publish a new immutable snapshot with a
+    single reference assignment (atomic under the GIL), so readers never lock.
+    The dict served to status polls is built once per update, not per poll.
+    """
     
     def __init__(self):
-        if self._initialized:
-            return
-        
-        self.status: SyncStatus = SyncStatus.IDLE
-        self.message: str = ""
-        self.progress: Optional[float] = None  # 0-100 for future progress tracking
-        self.error: Optional[str] = None
-        self.last_sync_time: Optional[datetime] = None
-        self.file_size_mb: Optional[float] = None
         self._state_lock = Lock()
-        self._initialized = True
+        self._publish(_StateSnapshot(
+            status=SyncStatus.IDLE,
+            message=_STATUS_MESSAGES[SyncStatus.IDLE],
+            progress=None,
+            error=None,
+            last_sync_time=None,
+            last_sync_time_iso=None,
+            file_size_mb=None
+        ))
         logger.info("SyncState initialized")
     
-    def set_checking(self):
-        """Set status to checking"""
+    def _publish(self, snap: _StateSnapshot) -> None:
+        """Store a new snapshot along with its pre-built state dict (call with the lock held)"""
+        self._state_dict = {
+            "status": snap.status.value,
+            "message": snap.message,
+            "progress": snap.progress,
+            "error": snap.error,
+            "last_sync_time": snap.last_sync_time_iso,
+            "file_size_mb": snap.file_size_mb
+        }
+        self._snapshot = snap
+    
+    @property
+    def status(self) -> SyncStatus:
+        """Current sync status"""
+        return self._snapshot.status
+    
+    def _transition(
+        self,
+        status: SyncStatus,
+        message: Optional[str] = None,
+        *,
+        progress: Optional[float] = None,
+        error: Optional[str] = None,
+        **changes
+    ) -> bool:
+        """
+        Move to a new status in one lock acquisition, if the transition is allowed.
+        
+        Args:
+            status: Status to move to
+            message: Status message (default: the fixed message for the status)
+            progress: Progress percentage (cleared unless given)
+            error: Error message (cleared unless given)
+            **changes: Other snapshot fields to update (kept from the current snapshot otherwise)
+            
+        Returns:
+            True if the state changed, False if the transition was rejected
+        """
         with self._state_lock:
-            self.status = SyncStatus.CHECKING
-            self.message = "Checking for updates..."
-            self.error = None
-            self.progress = None
-            logger.info("Sync status: CHECKING")
+            current = self._snapshot.status
+            if status not in _TRANSITIONS[current]:
+                logger.warning("Ignoring sync status change %s -> %s", current.name, status.name)
+                return False
+            self._publish(self._snapshot._replace(
+                status=status,
+                message=_STATUS_MESSAGES[status] if message is None else message,
+                progress=progress,
+                error=error,
+                **changes
+            ))
+        
+        if status is SyncStatus.ERROR:
+            logger.error("Sync status: ERROR - %s", error)
+        elif changes.get("file_size_mb"):
+            logger.info("Sync status: %s (size: %.2f MB)", status.name, changes["file_size_mb"])
+        else:
+            logger.info("Sync status: %s", status.name)
+        return True
+    
+    def set_checking(self) -> bool:
+        """Set status to checking. Returns False if a sync is already running."""
+        return self._transition(SyncStatus.CHECKING)
     
-    def set_downloading(self, file_size_mb: Optional[float] = None):
+    def set_downloading(self, file_size_mb: Optional[float] = None) -> bool:
         """Set status to downloading"""
-        with self._state_lock:
-            self.status = SyncStatus.DOWNLOADING
-            self.message = "Downloading database..."
-            self.error = None
-            self.progress = 0.0
-            self.file_size_mb = file_size_mb
-            logger.info(f"Sync status: DOWNLOADING (size: {file_size_mb:.2f} MB)" if file_size_mb else "Sync status: DOWNLOADING")
+        return self._transition(SyncStatus.DOWNLOADING, progress=0.0, file_size_mb=file_size_mb)
     
-    def set_completed(self, file_size_mb: Optional[float] = None):
+    def set_completed(self, file_size_mb: Optional[float] = None) -> bool:
         """Set status to completed"""
-        with self._state_lock:
-            self.status = SyncStatus.COMPLETED
-            self.message = f"Sync completed ({file_size_mb:.2f} MB)" if file_size_mb else "Sync completed"
-            self.error = None
-            self.progress = 100.0
-            self.last_sync_time = datetime.now(timezone.utc)
-            self.file_size_mb = file_size_mb
-            logger.info(f"Sync status: COMPLETED (size: {file_size_mb:.2f} MB)" if file_size_mb else "Sync status: COMPLETED")
+        now = datetime.now(timezone.utc)
+        return self._transition(
+            SyncStatus.COMPLETED,
+            f"Sync completed ({file_size_mb:.2f} MB)" if file_size_mb else None,
+            progress=100.0,
+            last_sync_time=now,
+            last_sync_time_iso=now.isoformat(),
+            file_size_mb=file_size_mb
+        )
     
-    def set_up_to_date(self):
+    def set_up_to_date(self) -> bool:
         """Set status to up-to-date"""
-        with self._state_lock:
-            self.status = SyncStatus.UP_TO_DATE
-            self.message = "Database is up to date"
-            self.error = None
-            self.progress = None
-            logger.info("Sync status: UP_TO_DATE")
+        return self._transition(SyncStatus.UP_TO_DATE)
     
-    def set_error(self, error_message: str):
+    def set_error(self, error_message: str) -> bool:
         """Set status to error"""
-        with self._state_lock:
-            self.status = SyncStatus.ERROR
-            self.message = "Sync failed"
-            self.error = error_message
-            self.progress = None
-            logger.error(f"Sync status: ERROR - {error_message}")
+        return self._transition(SyncStatus.ERROR, error=error_message)
     
-    def set_idle(self):
+    def set_idle(self) -> bool:
         """Reset to idle state"""
-        with self._state_lock:
-            self.status = SyncStatus.IDLE
-            self.message = ""
-            self.error = None
-            self.progress = None
-            logger.info("Sync status: IDLE")
+        return self._transition(SyncStatus.IDLE)
     
     def get_state(self) -> dict:
-        """Get current state as dict (thread-safe)"""
-        with self._state_lock:
-            return {
-                "status": self.status.value,
-                "message": self.message,
-                "progress": self.progress,
-                "error": self.error,
-                "last_sync_time": self.last_sync_time.isoformat() if self.last_sync_time else None,
-                "file_size_mb": self.file_size_mb
-            }
+        """Get current state as dict (lock-free, shared between callers - don't mutate it)"""
+        return self._state_dict
     
     def is_busy(self) -> bool:
         """Check if sync is currently in progress"""
-        with self._state_lock:
-            return self.status in [SyncStatus.CHECKING, SyncStatus.DOWNLOADING]
+        return self._snapshot.status in _BUSY_STATES
 
 
-# Global singleton instance
+# Global instance, created once at import (module import is already thread-safe)
 sync_state = SyncState()
 
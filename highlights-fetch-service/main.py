@@ -1,5 +1,6 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from app.api.endpoints import router as api_router
 from app.api.auth import router as auth_router
 from app.api.sync_status import router as sync_status_router
@@ -7,35 +8,158 @@ from app.api import kobo_companion
 from app.services.db_sync import db_sync_service
 from app.services.kobo_ai_companion import create_kobo_ai_companion, create_telegram_application
 from app.core.config import settings
+from app.core.cors import ALLOWED_ORIGINS
 from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
+import orjson
 import os
 import logging
+import logging.handlers
+import queue
+from typing import Optional
+
+try:
+    import fcntl
+    _HAS_FCNTL = True
+except ImportError:  # Windows
+    _HAS_FCNTL = False
 
 logger = logging.getLogger(__name__)
 
+# Background thread writing queued log records, and the root handler feeding it (see configure_logging)
+_log_listener: Optional[logging.handlers.QueueListener] = None
+_log_queue_handler: Optional[logging.handlers.QueueHandler] = None
+
+# Dedicated thread for database sync work, so a multi-MB B2 download never
+# occupies a worker in the default executor shared with the rest of the process
+_db_sync_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-sync")
+
+# Open fd holding the webhook lock for the life of the process (see _register_webhook)
+_webhook_lock_fd: Optional[int] = None
+
+# How long shutdown waits for a still-running webhook registration
+_WEBHOOK_SHUTDOWN_TIMEOUT_SECONDS = 5
+
 
 def configure_logging():
     """
     Configure logging for the application in an idempotent way.
-    Only sets up logging if it hasn't been configured yet.
-    This prevents conflicts when the app is imported or embedded.
+    
+    Records are handed to a queue and written by a QueueListener thread, so
+    logging from request handlers never blocks the event loop on I/O. Handlers
+    already on the root logger (e.g. from uvicorn's --log-config) are moved
+    behind the listener; if there are none, a stderr handler is set up.
     """
+    global _log_listener, _log_queue_handler
     root_logger = logging.getLogger()
     
-    # Check if logging is already configured (has handlers)
-    if root_logger.handlers:
+    # Check if this process already routes logging through the listener
+    if _log_listener:
         logger.info("Logging already configured, skipping setup")
         return
     
-    # Configure logging
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
+    handlers = list(root_logger.handlers)
+    if handlers:
+        for handler in handlers:
+            root_logger.removeHandler(handler)
+    else:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(
+            logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        )
+        handlers = [stream_handler]
+        root_logger.setLevel(logging.INFO)
+    
+    log_queue = queue.SimpleQueue()
+    _log_queue_handler = logging.handlers.QueueHandler(log_queue)
+    root_logger.addHandler(_log_queue_handler)
+    
+    _log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
     logger.info("Logging configured successfully")
 
 
+def stop_logging():
+    """
+    Flush queued log records, stop the logging listener thread and put its
+    handlers back on the root logger, so later records are still written and
+    configure_logging can run again.
+    """
+    global _log_listener, _log_queue_handler
+    root_logger = logging.getLogger()
+    if _log_queue_handler:
+        root_logger.removeHandler(_log_queue_handler)
+        _log_queue_handler = None
+    if _log_listener:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            root_logger.addHandler(handler)
+        _log_listener = None
+
+
+async def _register_webhook(bot) -> None:
+    """
+    Point Telegram's webhook at this server (only in one worker to avoid rate limits).
+    
+    Args:
+        bot: Telegram Bot of the initialized application
+    """
+    global _webhook_lock_fd
+    webhook_url = f"{settings.TELEGRAM_WEBHOOK_URL}/telegram-webhook"
+    
+    # Use an advisory lock to ensure only one worker sets the webhook. The lock
+    # is held for the life of the process and the kernel drops it when the
+    # process exits, so a crashed worker can't leave a stale lock behind.
+    lock_file = "/tmp/.telegram_webhook.lock"
+    try:
+        if _HAS_FCNTL:
+            lock_fd = os.open(lock_file, os.O_CREAT | os.O_WRONLY, 0o644)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker holds the lock and owns the webhook
+                os.close(lock_fd)
+                logger.info("ℹ️  Telegram webhook already set by another worker")
+                return
+        else:
+            # No flock (Windows): fall back to creating the lock file atomically,
+            # which can't tell a live owner from a file left by a crashed one
+            try:
+                lock_fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                logger.info("ℹ️  Telegram webhook already set by another worker")
+                return
+        _webhook_lock_fd = lock_fd
+        await bot.set_webhook(url=webhook_url)
+        logger.info("✅ Telegram webhook set to: %s", webhook_url)
+    except Exception as e:
+        logger.error("❌ Failed to set webhook: %s", e)
+
+
+async def _start_ai_companion() -> None:
+    """
+    Initialize the Kobo AI Companion and its Telegram application for webhooks.
+    
+    The webhook itself is registered by the lifespan once startup has succeeded.
+    """
+    logger.info("Initializing Kobo AI Companion...")
+    kobo_companion.kobo_companion = create_kobo_ai_companion()
+    
+    if kobo_companion.kobo_companion:
+        logger.info("✅ Kobo AI Companion initialized successfully")
+    else:
+        logger.warning("⚠️  Failed to initialize Kobo AI Companion")
+    
+    # Initialize Telegram application for webhooks
+    kobo_companion.telegram_app = await create_telegram_application()
+    if kobo_companion.telegram_app:
+        await kobo_companion.telegram_app.initialize()
+        logger.info("✅ Telegram application initialized for webhook mode")
+    else:
+        logger.warning("⚠️  Failed to initialize Telegram application")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
@@ -46,19 +170,27 @@ async def lifespan(app: FastAPI):
     configure_logging()
     logger.info("Application starting up...")
     
-    # Run blocking I/O operations in thread pool to avoid blocking event loop
-    loop = asyncio.get_event_loop()
+    # Start the AI companion now - it doesn't need the database, so its Telegram
+    # round trips overlap with the sync below instead of following it
+    companion_task = None
+    if settings.TELEGRAM_ENABLED:
+        companion_task = asyncio.create_task(_start_ai_companion())
+    else:
+        logger.info("ℹ️  Kobo AI Companion is disabled (TELEGRAM_ENABLED=False)")
+    
+    # Run the blocking download in a thread pool to avoid blocking event loop
+    loop = asyncio.get_running_loop()
     
     try:
-        # Check if database exists (non-blocking)
-        local_mtime = await loop.run_in_executor(None, db_sync_service.get_local_file_mtime)
+        # Check if database exists (a local stat - microseconds, not worth a thread hop)
+        local_mtime = db_sync_service.get_local_file_mtime()
         
         if local_mtime == 0:
             logger.warning("No local database cache found - initial sync required")
             logger.info("Initiating database download from B2...")
             
             # Run sync in thread pool (non-blocking)
-            sync_result = await loop.run_in_executor(None, db_sync_service.sync_if_needed)
+            sync_result = await loop.run_in_executor(_db_sync_executor, db_sync_service.sync_if_needed)
             
             if not sync_result:
                 # Sync failed - this is critical, we have no database
@@ -74,7 +206,7 @@ async def lifespan(app: FastAPI):
             logger.info("Initial database sync completed successfully")
             
             # Verify the database file actually exists after sync
-            final_mtime = await loop.run_in_executor(None, db_sync_service.get_local_file_mtime)
+            final_mtime = db_sync_service.get_local_file_mtime()
             if final_mtime == 0:
                 error_msg = (
                     "CRITICAL: Database file not found after successful sync. "
@@ -83,84 +215,79 @@ async def lifespan(app: FastAPI):
                 logger.error(error_msg)
                 raise SystemExit(1)
         else:
-            logger.info(f"Local database cache exists (mtime: {local_mtime}), skipping initial sync")
+            logger.info("Local database cache exists (mtime: %s), skipping initial sync", local_mtime)
     
     except SystemExit:
-        # Re-raise SystemExit to abort startup
+        # Re-raise SystemExit to abort startup, flushing the queued CRITICAL records first
+        if companion_task:
+            companion_task.cancel()
+        stop_logging()
         raise
     except Exception as e:
         # Unexpected error during startup
-        logger.error(f"Unexpected error during startup sync: {e}", exc_info=True)
+        logger.error("Unexpected error during startup sync: %s", e, exc_info=True)
         logger.error("Aborting startup due to unexpected error")
+        if companion_task:
+            companion_task.cancel()
+        stop_logging()
         raise SystemExit(1)
     
     logger.info("Application ready - database available")
     
-    # Initialize Kobo AI Companion (if enabled)
-    if settings.TELEGRAM_ENABLED:
-        logger.info("Initializing Kobo AI Companion...")
-        kobo_companion.kobo_companion = create_kobo_ai_companion()
-        
-        if kobo_companion.kobo_companion:
-            logger.info("✅ Kobo AI Companion initialized successfully")
-        else:
-            logger.warning("⚠️  Failed to initialize Kobo AI Companion")
-        
-        # Initialize Telegram application for webhooks
-        kobo_companion.telegram_app = await create_telegram_application()
-        if kobo_companion.telegram_app:
-            await kobo_companion.telegram_app.initialize()
-            logger.info("✅ Telegram application initialized for webhook mode")
-            
-            # Set webhook if URL is configured (only in one worker to avoid rate limits)
-            if settings.TELEGRAM_WEBHOOK_URL:
-                webhook_url = f"{settings.TELEGRAM_WEBHOOK_URL}/telegram-webhook"
-                
-                # Use a lock file to ensure only one worker sets the webhook
-                lock_file = "/tmp/.telegram_webhook.lock"
-                try:
-                    # Try to create lock file atomically
-                    import fcntl
-                    lock_fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-                    try:
-                        await kobo_companion.telegram_app.bot.set_webhook(url=webhook_url)
-                        logger.info(f"✅ Telegram webhook set to: {webhook_url}")
-                    finally:
-                        os.close(lock_fd)
-                except FileExistsError:
-                    # Another worker already set the webhook
-                    logger.info("ℹ️  Telegram webhook already set by another worker")
-                except Exception as e:
-                    logger.error(f"❌ Failed to set webhook: {e}")
-            else:
-                logger.warning("⚠️  TELEGRAM_WEBHOOK_URL not set - webhook not configured")
+    # Finish AI companion startup (it ran alongside the database sync)
+    if companion_task:
+        await companion_task
+    
+    # Set webhook if URL is configured - only now that startup can no longer abort,
+    # so Telegram is never pointed at a server that is exiting. It runs in the
+    # background so the server starts accepting requests without waiting on the Telegram API
+    if kobo_companion.telegram_app:
+        if settings.TELEGRAM_WEBHOOK_URL:
+            app.state.webhook_task = asyncio.create_task(
+                _register_webhook(kobo_companion.telegram_app.bot)
+            )
         else:
-            logger.warning("⚠️  Failed to initialize Telegram application")
-    else:
-        logger.info("ℹ️  Kobo AI Companion is disabled (TELEGRAM_ENABLED=False)")
+            logger.warning("⚠️  TELEGRAM_WEBHOOK_URL not set - webhook not configured")
+    
+    # The health payload only depends on startup results, so serialize it once
+    app.state.health_body = orjson.dumps({
+        "status": "ok",
+        "ai_companion": {
+            "enabled": settings.TELEGRAM_ENABLED,
+            "companion_initialized": kobo_companion.kobo_companion is not None,
+            "telegram_initialized": kobo_companion.telegram_app is not None
+        }
+    })
     
     # Yield control to the application
     yield
     
     # Shutdown: cleanup if needed
     logger.info("Application shutting down...")
+    webhook_task = getattr(app.state, "webhook_task", None)
+    if webhook_task and not webhook_task.done():
+        try:
+            await asyncio.wait_for(webhook_task, timeout=_WEBHOOK_SHUTDOWN_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning("⚠️  Telegram webhook registration still pending at shutdown - cancelled")
     if kobo_companion.telegram_app:
         await kobo_companion.telegram_app.shutdown()
         logger.info("✅ Telegram application shut down")
+    # The Telegram application shares this companion (create_kobo_ai_companion is cached)
+    if kobo_companion.kobo_companion:
+        await kobo_companion.kobo_companion.close()
+    
+    _db_sync_executor.shutdown(wait=False)
+    stop_logging()
 
 
-app = FastAPI(lifespan=lifespan)
-
-# CORS configuration
-frontend_url = os.getenv("FRONTEND_URL", "*")
-if frontend_url != "*" and "," in frontend_url:
-    allowed_origins = [origin.strip() for origin in frontend_url.split(",")]
-else:
-    allowed_origins = [frontend_url] if frontend_url != "*" else ["*"]
+# Serialize every JSON response with orjson (status endpoints are polled every few seconds)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
+# CORS configuration (see app/core/cors.py)
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=allowed_origins,
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -183,14 +310,7 @@ def read_root():
     }
 
 @app.api_route("/health", methods=["GET", "HEAD"])
-def health_check():
+async def health_check():
     """Health check endpoint for uptime monitoring services.
-    Supports both GET and HEAD requests."""
-    return {
-        "status": "ok",
-        "ai_companion": {
-            "enabled": settings.TELEGRAM_ENABLED,
-            "companion_initialized": kobo_companion.kobo_companion is not None,
-            "telegram_initialized": kobo_companion.telegram_app is not None
-        }
-    }
+    Supports both GET and HEAD requests. Serves the body built at startup."""
+    return Response(content=app.state.health_body, media_type="application/json")
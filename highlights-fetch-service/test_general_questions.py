@@ -14,6 +14,7 @@ Usage:
 import asyncio
 import os
 import sys
+import traceback
 from typing import Optional
 
 # Add parent directory to path for imports
@@ -64,27 +65,36 @@ async def test_general_question():
     print("Testing Question Processing")
     print("=" * 80)
     
-    for i, question in enumerate(test_questions, 1):
-        print(f"\n📝 Test {i}/{len(test_questions)}")
-        print(f"Question: {question}")
-        print("-" * 80)
+    # Generate all answers concurrently - the run takes as long as the slowest one
+    answers = await asyncio.gather(
+        *(companion.generate_general_answer(question) for question in test_questions),
+        return_exceptions=True
+    )
+    
+    for i, (question, answer) in enumerate(zip(test_questions, answers), 1):
+        # Build each test's report and write it in one go
+        out = [
+            f"\n📝 Test {i}/{len(test_questions)}",
+            f"Question: {question}",
+            "-" * 80,
+        ]
         
-        try:
-            # Generate answer
-            answer = await companion.generate_general_answer(question)
-            
-            # Display results
-            print(f"✅ Answer received ({len(answer)} characters)")
-            print(f"\nAnswer preview:")
-            print("-" * 80)
-            # Show first 300 characters
-            preview = answer[:300] + "..." if len(answer) > 300 else answer
-            print(preview)
-            print("-" * 80)
-            
-        except Exception as e:
-            print(f"❌ Error: {e}")
+        if isinstance(answer, Exception):
+            out.append(f"❌ Error: {answer}")
+            print("\n".join(out))
             return False
+        
+        # Display results
+        # Show first 300 characters
+        preview = answer[:300] + "..." if len(answer) > 300 else answer
+        out += [
+            f"✅ Answer received ({len(answer)} characters)",
+            f"\nAnswer preview:",
+            "-" * 80,
+            preview,
+            "-" * 80,
+        ]
+        print("\n".join(out))
     
     print("\n" + "=" * 80)
     print("✅ All tests passed!")
@@ -176,5 +186,4 @@ if __name__ == "__main__":
         print("\n\n⚠️  Test interrupted by user")
     except Exception as e:
         print(f"\n\n❌ Unexpected error: {e}")
-        import traceback
         traceback.print_exc()
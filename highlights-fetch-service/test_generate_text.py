@@ -0,0 +1,77 @@
+"""
+Test script for KoboAICompanion._generate_text
+
+Runs _generate_text against a stubbed _generate_content (no Gemini calls), with and
+without a system instruction, and checks that repeated prompts hit the response cache.
+
+Usage:
+    python test_generate_text.py
+"""
+
+import asyncio
+import os
+import sys
+from collections import OrderedDict
+from types import SimpleNamespace
+
+# Add parent directory to path for imports
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from google.genai import types
+from app.services.kobo_ai_companion import KoboAICompanion
+
+
+def _make_companion(calls: list) -> KoboAICompanion:
+    """Build a companion with only the state _generate_text needs and a stubbed Gemini call."""
+    companion = KoboAICompanion.__new__(KoboAICompanion)
+    companion._resp_cache = OrderedDict()
+    companion._inflight = {}
+
+    async def fake_generate_content(**kwargs):
+        calls.append(kwargs)
+        return SimpleNamespace(text=f"  answer {len(calls)}  ")
+
+    companion._generate_content = fake_generate_content
+    return companion
+
+
+async def test_generate_text():
+    """Check _generate_text builds its config and caches responses."""
+    print("=" * 70)
+    print("_generate_text Test")
+    print("=" * 70)
+
+    calls = []
+    companion = _make_companion(calls)
+
+    # Plain prompt - config passed through untouched
+    text = await companion._generate_text("model", "prompt")
+    assert text == "answer 1", text
+    assert calls[-1]["config"] is None, calls[-1]
+    print("✅ Plain prompt")
+
+    # System instruction - added on top of the caller's config
+    text = await companion._generate_text(
+        "model",
+        "prompt",
+        config=types.GenerateContentConfig(response_mime_type="application/json"),
+        system_instruction="instructions"
+    )
+    assert text == "answer 2", text
+    config = calls[-1]["config"]
+    assert config.system_instruction == "instructions", config
+    assert config.response_mime_type == "application/json", config
+    print("✅ System instruction on top of config")
+
+    # Repeated prompt - answered from the response cache
+    text = await companion._generate_text("model", "prompt")
+    assert text == "answer 1", text
+    assert len(calls) == 2, calls
+    print("✅ Repeated prompt served from cache")
+
+    print()
+    print("✅ All checks passed!")
+
+
+if __name__ == "__main__":
+    asyncio.run(test_generate_text())
@@ -11,15 +11,29 @@ Example:
 """
 
 import sys
-import requests
+import aiohttp
+import asyncio
+import orjson
 import os
-from pathlib import Path
+import traceback
 
+# Content types for the supported image extensions
+_CONTENT_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+}
 
-def test_image_api(image_path: str, question: str = "What can you tell me about this image?"):
+
+async def test_image_api(image_path: str, question: str = "What can you tell me about this image?"):
     """
     Test the image understanding API endpoint
     
+    The image is streamed from disk as the multipart body is written,
+    so it is never held in memory in full.
+    
     Args:
         image_path: Path to the image file
         question: Question to ask about the image
@@ -34,19 +48,17 @@ def test_image_api(image_path: str, question: str = "What can you tell me about
     print("=" * 70)
     print()
     
-    # Validate image path
-    if not os.path.exists(image_path):
+    # Validate image path and get file info from a single stat
+    try:
+        file_size = os.stat(image_path).st_size
+    except FileNotFoundError:
         print(f"❌ Error: Image file not found: {image_path}")
         return
-    
-    # Get file info
-    file_size = os.path.getsize(image_path)
-    file_ext = Path(image_path).suffix.lower()
+    file_ext = os.path.splitext(image_path)[1].lower()
     
     # Validate file type
-    valid_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.webp']
-    if file_ext not in valid_extensions:
-        print(f"❌ Error: Invalid file type '{file_ext}'. Supported: {', '.join(valid_extensions)}")
+    if file_ext not in _CONTENT_TYPES:
+        print(f"❌ Error: Invalid file type '{file_ext}'. Supported: {', '.join(_CONTENT_TYPES)}")
         return
     
     # Check file size
@@ -67,74 +79,72 @@ def test_image_api(image_path: str, question: str = "What can you tell me about
     try:
         # Prepare request
         headers = {"X-API-Key": API_KEY}
+        timeout = aiohttp.ClientTimeout(total=60)
         
-        with open(image_path, "rb") as image_file:
-            files = {"image": (os.path.basename(image_path), image_file)}
-            data = {
-                "question": question,
-                "send_to_telegram": "true"
-            }
-            
-            # Send request
-            response = requests.post(
-                API_URL,
-                headers=headers,
-                files=files,
-                data=data,
-                timeout=60
-            )
-        
-        print(f"📡 Response Status: {response.status_code}")
-        print()
-        
-        # Handle response
-        if response.status_code == 200:
-            result = response.json()
-            
-            print("✅ Success!")
-            print()
-            print("=" * 70)
-            print("AI Analysis:")
-            print("=" * 70)
-            print(result['answer'])
-            print("=" * 70)
-            print()
-            print(f"📊 Details:")
-            print(f"  - Image filename: {result.get('image_filename')}")
-            print(f"  - Image size: {result.get('image_size_bytes')} bytes")
-            print(f"  - Sent to Telegram: {result.get('sent_to_telegram')}")
-            
-        elif response.status_code == 401:
-            print("❌ Authentication failed!")
-            print("   Make sure KOBO_API_KEY environment variable is set correctly.")
-            print(f"   Current API Key: {API_KEY[:10]}...")
-            
-        elif response.status_code == 503:
-            print("❌ Service unavailable!")
-            print("   The AI Companion service is not running or not configured.")
-            print("   Check that TELEGRAM_ENABLED=true and all credentials are set.")
-            
-        else:
-            print(f"❌ Error: {response.status_code}")
-            try:
-                error_detail = response.json()
-                print(f"   Details: {error_detail}")
-            except:
-                print(f"   Response: {response.text}")
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            with open(image_path, "rb") as image_file:
+                form = aiohttp.FormData()
+                form.add_field(
+                    "image",
+                    image_file,
+                    filename=os.path.basename(image_path),
+                    content_type=_CONTENT_TYPES[file_ext]
+                )
+                form.add_field("question", question)
+                form.add_field("send_to_telegram", "true")
+                
+                # Send request
+                async with session.post(API_URL, headers=headers, data=form) as response:
+                    print(f"📡 Response Status: {response.status}")
+                    print()
+                    
+                    # Handle response
+                    if response.status == 200:
+                        result = await response.json(loads=orjson.loads)
+                        
+                        print("✅ Success!")
+                        print()
+                        print("=" * 70)
+                        print("AI Analysis:")
+                        print("=" * 70)
+                        print(result['answer'])
+                        print("=" * 70)
+                        print()
+                        print(f"📊 Details:")
+                        print(f"  - Image filename: {result.get('image_filename')}")
+                        print(f"  - Image size: {result.get('image_size_bytes')} bytes")
+                        print(f"  - Sent to Telegram: {result.get('sent_to_telegram')}")
+                        
+                    elif response.status == 401:
+                        print("❌ Authentication failed!")
+                        print("   Make sure KOBO_API_KEY environment variable is set correctly.")
+                        print(f"   Current API Key: {API_KEY[:10]}...")
+                        
+                    elif response.status == 503:
+                        print("❌ Service unavailable!")
+                        print("   The AI Companion service is not running or not configured.")
+                        print("   Check that TELEGRAM_ENABLED=true and all credentials are set.")
+                        
+                    else:
+                        print(f"❌ Error: {response.status}")
+                        try:
+                            error_detail = await response.json(loads=orjson.loads)
+                            print(f"   Details: {error_detail}")
+                        except:
+                            print(f"   Response: {await response.text()}")
         
-    except requests.exceptions.ConnectionError:
+    except aiohttp.ClientConnectionError:
         print("❌ Connection Error!")
         print(f"   Could not connect to {API_URL}")
         print("   Make sure the server is running.")
         
-    except requests.exceptions.Timeout:
+    except asyncio.TimeoutError:
         print("❌ Timeout!")
         print("   Request took too long (>60s).")
         print("   The image might be too complex or the API is slow.")
         
     except Exception as e:
         print(f"❌ Unexpected error: {e}")
-        import traceback
         traceback.print_exc()
     
     print()
@@ -160,7 +170,7 @@ def main():
     image_path = sys.argv[1]
     question = sys.argv[2] if len(sys.argv) > 2 else "What can you tell me about this image?"
     
-    test_image_api(image_path, question)
+    asyncio.run(test_image_api(image_path, question))
 
 
 if __name__ == "__main__":
@@ -10,6 +10,7 @@ Usage:
 import asyncio
 import os
 import sys
+import traceback
 from pathlib import Path
 
 # Add parent directory to path for imports
@@ -18,6 +19,13 @@ sys.path.insert(0, str(Path(__file__).parent))
 from app.services.kobo_ai_companion import create_kobo_ai_companion
 from app.core.config import settings
 
+# Minimal 1x1 red pixel PNG
+_TEST_PNG_1X1_RED = (
+    b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00'
+    b'\x1f\x15\xc4\x89\x00\x00\x00\rIDATx\xdac\xfc\xcf\xc0\xf0\x1f\x00\x05\x05\x02\x00_\xc8'
+    b'\xf1\xd2\x00\x00\x00\x00IEND\xaeB`\x82'
+)
+
 
 async def test_image_understanding():
     """Test the image understanding capability"""
@@ -71,12 +79,8 @@ async def test_image_understanding():
     print("📝 Testing image analysis (simulated)...")
     print()
     
-    # Create a simple test image (1x1 red pixel PNG)
-    import base64
-    
-    # Minimal 1x1 red pixel PNG (base64 encoded)
-    test_png_b64 = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8DwHwAFBQIAX8jx0gAAAABJRU5ErkJggg=="
-    test_image_bytes = base64.b64decode(test_png_b64)
+    # Use a simple test image (1x1 red pixel PNG)
+    test_image_bytes = _TEST_PNG_1X1_RED
     
     question = "This is a test image. Just acknowledge that you can see it."
     
@@ -99,7 +103,6 @@ async def test_image_understanding():
         
     except Exception as e:
         print(f"❌ Error during analysis: {e}")
-        import traceback
         traceback.print_exc()
         return
     
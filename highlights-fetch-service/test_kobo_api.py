@@ -2,75 +2,100 @@
 """
 Test script for Kobo AI Companion API
 
-Tests the /kobo-ask endpoint with sample data.
+Tests the /kobo-ask endpoint with sample data. All test cases are sent
+concurrently, so the run takes about as long as the slowest request.
 """
 
-import requests
-import json
+import aiohttp
+import argparse
+import asyncio
+import orjson
 import sys
-from typing import Dict, Any
+import traceback
+from typing import Dict, Any, List, Tuple
 
+# Characters of each answer shown, and the most bytes read to get them
+# (500 characters are at most 2000 bytes of UTF-8)
+_PREVIEW_CHARS = 500
+_PREVIEW_MAX_BYTES = _PREVIEW_CHARS * 4
 
-def test_kobo_ask(api_url: str, api_key: str, test_data: Dict[str, Any]) -> bool:
+
+async def test_kobo_ask(
+    session: aiohttp.ClientSession,
+    api_url: str,
+    test_data: Dict[str, Any]
+) -> Tuple[bool, List[str]]:
     """
     Test sending a question/highlight to the API.
     
+    Output is collected rather than printed, so concurrent test cases
+    don't interleave their lines.
+    
     Args:
+        session: Shared keep-alive HTTP session (carries the API key header)
         api_url: The API endpoint URL
-        api_key: The API key for authentication
         test_data: The test request data
         
     Returns:
-        True if successful, False otherwise
+        Tuple of (True if successful, output lines)
     """
-    headers = {
-        "X-API-Key": api_key,
-        "Content-Type": "application/json"
-    }
-    
     book = test_data['context']['book']
     author = test_data['context']['author']
     
-    print(f"Testing API: {api_url}")
-    print(f"Question from '{book}' by {author}")
-    print(f"Text: {test_data['text'][:60]}...")
-    print("-" * 60)
+    out = [
+        f"Testing API: {api_url}",
+        f"Question from '{book}' by {author}",
+        f"Text: {test_data['text'][:60]}...",
+        "-" * 60,
+    ]
     
     try:
-        response = requests.post(
+        # Encode the body with orjson rather than aiohttp's stdlib json default
+        async with session.post(
             api_url,
-            json=test_data,
-            headers=headers,
-            timeout=30
-        )
-        
-        print(f"Status Code: {response.status_code}")
-        
-        if response.status_code == 200:
-            # Response is plain text (for Kobo dialog)
-            explanation = response.text
-            print(f"✅ Success!")
-            print(f"Response (plain text):")
-            print("-" * 60)
-            print(explanation[:500])  # Show first 500 chars
-            if len(explanation) > 500:
-                print("...")
-                print(f"(Total length: {len(explanation)} characters)")
-            print("-" * 60)
-            print(f"💬 Full analysis sent to Telegram in background")
-            return True
-        else:
-            print(f"❌ Failed!")
-            print(f"Error: {response.text}")
-            return False
+            data=orjson.dumps(test_data),
+            headers={"Content-Type": "application/json"}
+        ) as response:
+            out.append(f"Status Code: {response.status}")
             
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Request failed: {e}")
-        return False
+            if response.status == 200:
+                # Response is plain text (for Kobo dialog). Only the preview is
+                # shown, so read just enough of the body for it
+                preview_bytes = bytearray()
+                async for chunk in response.content.iter_chunked(512):
+                    preview_bytes += chunk
+                    if len(preview_bytes) >= _PREVIEW_MAX_BYTES:
+                        break
+                # errors="ignore" drops a character cut in half at the read boundary
+                explanation = preview_bytes.decode(response.charset or "utf-8", errors="ignore")
+                out.append(f"✅ Success!")
+                out.append(f"Response (plain text):")
+                out.append("-" * 60)
+                out.append(explanation[:_PREVIEW_CHARS])  # Show first 500 chars
+                if len(explanation) > _PREVIEW_CHARS or not response.content.at_eof():
+                    out.append("...")
+                    if response.content_length is not None:
+                        out.append(f"(Total length: {response.content_length} bytes)")
+                out.append("-" * 60)
+                out.append(f"💬 Full analysis sent to Telegram in background")
+                return True, out
+            else:
+                out.append(f"❌ Failed!")
+                out.append(f"Error: {await response.text()}")
+                return False, out
+            
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        out.append(f"❌ Request failed: {e!r}")
+        return False, out
 
 
-def main():
-    """Main test function."""
+async def main(interactive: bool = False):
+    """
+    Main test function.
+    
+    Args:
+        interactive: Ask for confirmation before running with the placeholder API key
+    """
     print("=" * 60)
     print("Kobo AI Companion API Test (/kobo-ask)")
     print("=" * 60)
@@ -120,33 +145,37 @@ def main():
         print("Please update API_KEY in this script with your actual key.")
         print()
         
-        user_input = input("Continue anyway? (y/n): ")
-        if user_input.lower() != 'y':
-            print("Exiting...")
-            sys.exit(0)
-        print()
+        if interactive:
+            user_input = input("Continue anyway? (y/n): ")
+            if user_input.lower() != 'y':
+                print("Exiting...")
+                sys.exit(0)
+            print()
+    
+    # Run all tests concurrently over one keep-alive session, with the
+    # authentication header set once for every request
+    connector = aiohttp.TCPConnector(limit=16, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=30)
+    headers = {"X-API-Key": API_KEY}
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers) as session:
+        async with asyncio.TaskGroup() as tg:
+            tasks = []
+            for test_data in test_cases:
+                # Remove None chapter if present
+                if test_data['context'].get("chapter") is None:
+                    test_data_clean = test_data.copy()
+                    test_data_clean['context'] = {k: v for k, v in test_data['context'].items() if k != "chapter" or v is not None}
+                else:
+                    test_data_clean = test_data
+                
+                tasks.append(tg.create_task(test_kobo_ask(session, API_URL, test_data_clean)))
     
-    # Run tests
     results = []
-    for i, test_data in enumerate(test_cases, 1):
-        print(f"Test Case #{i}")
-        print("=" * 60)
-        
-        # Remove None chapter if present
-        if test_data['context'].get("chapter") is None:
-            test_data_clean = test_data.copy()
-            test_data_clean['context'] = {k: v for k, v in test_data['context'].items() if k != "chapter" or v is not None}
-        else:
-            test_data_clean = test_data
-        
-        success = test_kobo_ask(API_URL, API_KEY, test_data_clean)
+    for i, task in enumerate(tasks, 1):
+        success, out = task.result()
         results.append(success)
-        
-        print()
-        
-        if i < len(test_cases):
-            input("Press Enter to continue to next test...")
-            print()
+        # One write per case instead of one per line
+        print("\n".join([f"Test Case #{i}", "=" * 60, *out, ""]))
     
     # Summary
     print("=" * 60)
@@ -171,14 +200,21 @@ def main():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Test the /kobo-ask endpoint")
+    parser.add_argument(
+        "--interactive",
+        action="store_true",
+        help="prompt before running with the placeholder API key (default: run unattended)"
+    )
+    args = parser.parse_args()
+    
     try:
-        exit_code = main()
+        exit_code = asyncio.run(main(interactive=args.interactive))
         sys.exit(exit_code)
     except KeyboardInterrupt:
         print("\n\nTest interrupted by user.")
         sys.exit(130)
     except Exception as e:
         print(f"\n❌ Unexpected error: {e}")
-        import traceback
         traceback.print_exc()
         sys.exit(1)
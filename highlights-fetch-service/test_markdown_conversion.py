@@ -5,52 +5,13 @@ This script demonstrates how Markdown syntax is converted to HTML
 when Telegram's Markdown parser fails.
 """
 
-import re
-import html
+import os
+import sys
 
+# Add parent directory to path for imports
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-def markdown_to_html(text: str) -> str:
-    """
-    Convert common Markdown syntax to HTML tags for Telegram HTML parse mode.
-    """
-    # First, escape HTML special characters to avoid conflicts
-    text = html.escape(text, quote=False)
-    
-    # Convert headings (###, ##, #) to bold
-    text = re.sub(r'^#{1,6}\s+(.+)$', r'<b>\1</b>', text, flags=re.MULTILINE)
-    
-    # Convert **bold** (must be before * for italic)
-    text = re.sub(r'\*\*(.+?)\*\*', r'<b>\1</b>', text)
-    
-    # Convert __underline__
-    text = re.sub(r'__(.+?)__', r'<u>\1</u>', text)
-    
-    # Convert *italic* (single asterisk)
-    text = re.sub(r'\*(.+?)\*', r'<i>\1</i>', text)
-    
-    # Convert _italic_ (single underscore) 
-    text = re.sub(r'(?<!\w)_(.+?)_(?!\w)', r'<i>\1</i>', text)
-    
-    # Convert `code`
-    text = re.sub(r'`(.+?)`', r'<code>\1</code>', text)
-    
-    # Convert [link](url) - extract URL first since it's already escaped
-    def replace_link(match):
-        link_text = match.group(1)
-        url = match.group(2)
-        # Unescape the URL since we escaped it earlier
-        url = url.replace('&amp;', '&').replace('&lt;', '<').replace('&gt;', '>')
-        return f'<a href="{url}">{link_text}</a>'
-    
-    text = re.sub(r'\[(.+?)\]\((.+?)\)', replace_link, text)
-    
-    # Convert bullet points (-, *, +) to • 
-    text = re.sub(r'^[\-\*\+]\s+', '• ', text, flags=re.MULTILINE)
-    
-    # Convert numbered lists (1., 2., etc.)
-    text = re.sub(r'^\d+\.\s+', lambda m: f'{m.group(0)} ', text, flags=re.MULTILINE)
-    
-    return text
+from app.services.markdown_html import markdown_to_html
 
 
 def test_conversion():
@@ -72,6 +33,8 @@ def test_conversion():
         ("- Item 1\n- Item 2\n- Item 3", "Bullet list"),
         ("1. First\n2. Second\n3. Third", "Numbered list"),
         ("[Link text](https://example.com)", "Link"),
+        ("`code *x*`", "Formatting inside code"),
+        ("***Bold italic***", "Bold italic"),
     ]
     
     for markdown, description in test_cases: